@@ -1,3 +1,5 @@
 '''ImagePicker: an application for viewing and choosing images.'''
-__all__ = ['main', 'ui', 'utils', 'model']
+__all__ = ['main', 'ui', 'utils', 'model', 'analysis', 'archive', 'cache',
+           'decoders', 'isolate', 'navigation', 'partition', 'raw', 'search',
+           'watch']
 __version__ = '0.2'
@@ -0,0 +1,191 @@
+#-*- coding: utf-8 -*-
+'''
+Scoring images for sharpness and exposure, so that the obvious rejects can be
+skipped without having to look at them.
+
+This needs NumPy and Pillow; without them, `available()` is False.
+'''
+import io
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import time
+import typing as T
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = Image = None
+
+from imagepicker.isolate import limitMemory
+from imagepicker.utils import readImageBytes
+
+
+Scores = T.NamedTuple('Scores', [('sharpness', float), ('brightness', float),
+                                 ('clipped', float)])
+
+# images are scored at (about) this size, so that sharpness is comparable
+# between images of different resolutions -- and it's much quicker
+ANALYSIS_SIZE = (1024, 1024)
+
+# below this variance of the Laplacian, an image is probably blurry
+MIN_SHARPNESS = 100.0
+# mean brightness (0-1) outside this range is probably badly exposed
+BRIGHTNESS_RANGE = (0.1, 0.9)
+# nor do we want more than this fraction of pixels crushed or blown out
+MAX_CLIPPED = 0.25
+
+# seconds to score one file before giving up on it, and to start a worker
+FILE_TIMEOUT = 30.0
+STARTUP_TIMEOUT = 60.0
+MEMORY_LIMIT = 2 * 1024 ** 3
+
+
+def available() -> bool:
+    return np is not None
+
+
+def scoreImage(data: bytes) -> Scores:
+    '''Score the image for sharpness and exposure.'''
+    img = Image.open(io.BytesIO(data))
+    # JPEG draft mode decodes at a reduced size, and straight to greyscale
+    img.draft('L', ANALYSIS_SIZE)
+    img = img.convert('L')
+    img.thumbnail(ANALYSIS_SIZE)
+    pixels = np.asarray(img, dtype=np.float32)
+
+    laplacian = (pixels[:-2, 1:-1] + pixels[2:, 1:-1] + pixels[1:-1, :-2]
+                 + pixels[1:-1, 2:] - 4 * pixels[1:-1, 1:-1])
+
+    histogram = np.bincount(np.asarray(img).ravel(), minlength=256)
+    total = histogram.sum()
+    brightness = float(np.dot(histogram, np.arange(256))) / (255 * total)
+    clipped = float(histogram[:3].sum() + histogram[-3:].sum()) / total
+
+    return Scores(float(laplacian.var()), brightness, clipped)
+
+
+def scoreFile(filename: str) -> T.Optional[Scores]:
+    '''Score the file, or None if it can't be read.'''
+    try:
+        return scoreImage(readImageBytes(filename))
+    # anything from a truncated file to Pillow's DecompressionBombError --
+    # one bad file mustn't stop the rest being scored
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+def _serve(conn: T.Any, memoryLimit: int) -> None:
+    '''Worker process: score whatever files we're sent until the pipe closes.'''
+    limitMemory(memoryLimit)
+    conn.send(None)  # ready
+    while True:
+        try:
+            filename = conn.recv()
+        except EOFError:
+            return
+        conn.send(scoreFile(filename))
+
+
+class _Scorer:
+    '''A scoring process, and the file it's working on.'''
+
+    def __init__(self, context: T.Any, memoryLimit: int) -> None:
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_serve, daemon=True,
+                                       args=(child, memoryLimit),
+                                       name='ImagePicker analysis')
+        self.process.start()
+        child.close()
+        self.filename = None  # type: T.Optional[str]
+        self.started = 0.0
+
+    def waitUntilReady(self) -> None:
+        try:
+            if self.conn.poll(STARTUP_TIMEOUT):
+                self.conn.recv()
+                return
+        except (EOFError, OSError):
+            pass
+        self.kill()
+        raise RuntimeError('analysis process did not start')
+
+    def send(self, filename: str) -> None:
+        self.filename = filename
+        self.started = time.monotonic()
+        self.conn.send(filename)
+
+    def kill(self) -> None:
+        self.process.terminate()
+        self.process.join(1)
+        self.conn.close()
+
+
+def analyzeFiles(filenames: T.Sequence[str], workers: int=None,
+                 timeout: float=FILE_TIMEOUT, memoryLimit: int=MEMORY_LIMIT
+                 ) -> T.Iterator[T.Tuple[str, T.Optional[Scores]]]:
+    '''Score the files across a pool of processes, yielding as they finish.
+
+    Each worker has a memory limit, and a file that takes longer than
+    `timeout` to score -- or that kills its worker -- scores None, and the
+    worker is replaced. Stopping early kills the workers.
+    '''
+    # spawned rather than forked, since we're a threaded Qt application
+    context = multiprocessing.get_context('spawn')
+    workers = min(workers or os.cpu_count() or 1, len(filenames))
+    todo = list(reversed(filenames))
+    scorers = []  # type: T.List[_Scorer]
+
+    def replace(scorer: _Scorer) -> _Scorer:
+        scorer.kill()
+        scorers.remove(scorer)
+        fresh = _Scorer(context, memoryLimit)
+        scorers.append(fresh)
+        fresh.waitUntilReady()
+        return fresh
+
+    try:
+        scorers.extend(_Scorer(context, memoryLimit) for _ in range(workers))
+        for scorer in scorers:
+            scorer.waitUntilReady()
+
+        idle = list(scorers)
+        busy = {}  # type: T.Dict[T.Any, _Scorer]
+        while todo or busy:
+            while idle and todo:
+                scorer = idle.pop()
+                scorer.send(todo.pop())
+                busy[scorer.conn] = scorer
+
+            deadline = min(s.started for s in busy.values()) + timeout
+            for conn in wait(list(busy), max(0, deadline - time.monotonic())):
+                scorer = busy.pop(conn)
+                filename = scorer.filename
+                try:
+                    scores = conn.recv()
+                except (EOFError, OSError):
+                    # most likely killed for going over its memory limit
+                    scores = None
+                    scorer = replace(scorer)
+                yield filename, scores
+                idle.append(scorer)
+
+            now = time.monotonic()
+            for conn, scorer in list(busy.items()):
+                if now - scorer.started > timeout:
+                    del busy[conn]
+                    filename, scorer = scorer.filename, replace(scorer)
+                    yield filename, None
+                    idle.append(scorer)
+    finally:
+        for scorer in scorers:
+            scorer.kill()
+
+
+def isLikelyReject(scores: Scores) -> bool:
+    '''Is the image probably blurry or badly exposed?'''
+    low, high = BRIGHTNESS_RANGE
+    return (scores.sharpness < MIN_SHARPNESS
+            or not low <= scores.brightness <= high
+            or scores.clipped > MAX_CLIPPED)
@@ -0,0 +1,261 @@
+#-*- coding: utf-8 -*-
+'''
+Reading images straight out of ZIP and (uncompressed) TAR archives, without
+extracting them first.
+
+Members are addressed as if the archive were a directory, e.g.
+`/data/dump.zip/2019/IMG_0001.JPG`. Each archive's member offsets are indexed
+once, and the index is kept in the user's cache directory, so that reopening
+the archive -- from any process -- doesn't mean reading through it all again.
+'''
+import hashlib
+import io
+import json
+import os
+import posixpath
+import tarfile
+import threading
+import typing as T
+import zipfile
+import zlib
+
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar')
+
+_CHUNK_SIZE = 1024 * 1024
+# fixed part of a ZIP local file header; the name and extra field follow it
+_ZIP_LOCAL_HEADER = 30
+
+# name, offset, compression, compressed size, size -- the offset being of the
+# local header for ZIP members, and of the data for TAR members
+Member = T.Tuple[str, int, int, int, int]
+
+
+def isArchive(path: str) -> bool:
+    return path.lower().endswith(ARCHIVE_EXTENSIONS) and os.path.isfile(path)
+
+
+def indexPathFor(path: str) -> str:
+    '''Where the archive's index is kept -- the same for every process.'''
+    path = os.path.abspath(path)
+    cacheDir = os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'imagepicker', 'archives')
+    digest = hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(cacheDir, '{}.{}.json'.format(
+        os.path.basename(path), digest[:16]))
+
+
+class _MemberFile(io.RawIOBase):
+    '''A seekable view of a stored (uncompressed) member's bytes.'''
+
+    def __init__(self, f: T.BinaryIO, start: int, size: int) -> None:
+        super().__init__()
+        self._file = f
+        self._start = start
+        self._size = size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos,
+                io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def readinto(self, buf: T.Any) -> int:
+        count = max(0, min(len(buf), self._size - self._pos))
+        if not count:
+            return 0
+        self._file.seek(self._start + self._pos)
+        count = self._file.readinto(memoryview(buf)[:count])
+        self._pos += count
+        return count
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
+
+class ArchiveIndex:
+    '''Where each member of an archive is, so we can seek straight to it.'''
+
+    def __init__(self, path: str, indexPath: str=None) -> None:
+        self.path = path
+        self.indexPath = indexPath
+        stat = os.stat(path)
+        self._signature = [stat.st_size, stat.st_mtime]
+        self.kind = 'zip' if zipfile.is_zipfile(path) else 'tar'
+        if not self._loadIndex():
+            self._members = self._build()
+            self._saveIndex()
+        self._byName = {m[0]: m for m in self._members}
+
+    @property
+    def names(self) -> T.List[str]:
+        return [m[0] for m in self._members]
+
+    def _build(self) -> T.List[Member]:
+        if self.kind == 'zip':
+            with zipfile.ZipFile(self.path) as zf:
+                return [(posixpath.normpath(info.filename), info.header_offset,
+                         info.compress_type, info.compress_size, info.file_size)
+                        for info in zf.infolist() if not info.is_dir()]
+
+        try:
+            tf = tarfile.open(self.path, 'r:')
+        except tarfile.ReadError:
+            raise ValueError('{}: compressed TAR archives need extracting '
+                             'first'.format(self.path))
+        with tf:
+            return [(posixpath.normpath(info.name), info.offset_data,
+                     zipfile.ZIP_STORED, info.size, info.size)
+                    for info in tf if info.isfile()]
+
+    def _loadIndex(self) -> bool:
+        if not self.indexPath or not os.path.exists(self.indexPath):
+            return False
+        with open(self.indexPath, 'r') as f:
+            contents = json.load(f)
+        # stale if the archive's changed since
+        if contents.get('signature') != self._signature:
+            return False
+        self._members = [tuple(m) for m in contents['members']]
+        return True
+
+    def _saveIndex(self) -> None:
+        if not self.indexPath:
+            return
+        # it only saves time, so there's no need to fail over it
+        try:
+            os.makedirs(os.path.dirname(self.indexPath), exist_ok=True)
+            tmpPath = self.indexPath + '.tmp'
+            with open(tmpPath, 'w') as f:
+                json.dump({'archive': self.path, 'kind': self.kind,
+                           'signature': self._signature,
+                           'members': self._members}, f)
+            os.replace(tmpPath, self.indexPath)
+        except OSError:
+            pass
+
+    def iterMember(self, name: str,
+                   chunkSize: int=_CHUNK_SIZE) -> T.Iterator[bytes]:
+        '''Stream a member's (uncompressed) bytes, a chunk at a time.
+
+        Deflated members are never inflated past their recorded size, so that
+        a ZIP bomb is caught rather than filling memory or the disk.
+        '''
+        if name not in self._byName:
+            raise FileNotFoundError('{}: no member {}'.format(self.path, name))
+        _, offset, compression, compressedSize, size = self._byName[name]
+        if compression not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            # rare enough to leave to zipfile -- found by offset, since our
+            # names are normalised
+            with zipfile.ZipFile(self.path) as zf:
+                info = next(i for i in zf.infolist()
+                            if i.header_offset == offset)
+                with zf.open(info) as member:
+                    yield from iter(lambda: member.read(chunkSize), b'')
+            return
+
+        decompressor = (zlib.decompressobj(-zlib.MAX_WBITS)
+                        if compression == zipfile.ZIP_DEFLATED else None)
+        with open(self.path, 'rb') as f:
+            f.seek(self._dataOffset(f, offset))
+            remaining = compressedSize
+            inflated = 0
+            while remaining > 0:
+                chunk = f.read(min(chunkSize, remaining))
+                if not chunk:
+                    raise ValueError('{}: truncated member {}'.format(
+                        self.path, name))
+                remaining -= len(chunk)
+                if decompressor:
+                    # one byte more than it should have is enough to know
+                    chunk = decompressor.decompress(chunk, size - inflated + 1)
+                    inflated += len(chunk)
+                    if inflated > size:
+                        raise ValueError('{}: {} inflates past its recorded '
+                                         'size'.format(self.path, name))
+                yield chunk
+            if decompressor:
+                yield decompressor.flush()
+
+    def read(self, name: str, maxSize: int=None) -> bytes:
+        '''A member's bytes, in (usually) a single seek and read.
+
+        A member whose recorded size is over `maxSize` raises a ValueError
+        before anything is read, let alone inflated.
+        '''
+        if (name in self._byName and maxSize is not None
+                and self._byName[name][4] > maxSize):
+            raise ValueError('{}: {} is too large ({} bytes)'.format(
+                self.path, name, self._byName[name][4]))
+        return b''.join(self.iterMember(name, chunkSize=1 << 62))
+
+    def isStored(self, name: str) -> bool:
+        '''Is the member stored uncompressed, so that it can be seeked in?'''
+        return (name in self._byName
+                and self._byName[name][2] == zipfile.ZIP_STORED)
+
+    def openMember(self, name: str) -> T.BinaryIO:
+        '''Open a stored member as a seekable file, without reading it in.'''
+        if not self.isStored(name):
+            raise ValueError('{}: {} is compressed, so not seekable'.format(
+                self.path, name))
+        _, offset, _, size, _ = self._byName[name]
+        f = open(self.path, 'rb')
+        try:
+            start = self._dataOffset(f, offset)
+        except BaseException:
+            f.close()
+            raise
+        return io.BufferedReader(_MemberFile(f, start, size))
+
+    def _dataOffset(self, f: T.BinaryIO, offset: int) -> int:
+        if self.kind != 'zip':
+            return offset
+        # the local header's name and extra field can differ from the
+        # central directory's, so they have to be read here
+        f.seek(offset + 26)
+        header = f.read(4)
+        nameLength = int.from_bytes(header[:2], 'little')
+        extraLength = int.from_bytes(header[2:], 'little')
+        return offset + _ZIP_LOCAL_HEADER + nameLength + extraLength
+
+
+_archives = {}  # type: T.Dict[str, ArchiveIndex]
+_lock = threading.Lock()
+
+
+def openArchive(path: str, indexPath: str=None) -> ArchiveIndex:
+    '''Index the archive (or reuse the index we have), and remember it.
+
+    The index is kept at `indexPathFor(path)` unless told otherwise.
+    '''
+    path = os.path.abspath(path)
+    with _lock:
+        if path not in _archives:
+            _archives[path] = ArchiveIndex(path, indexPath or indexPathFor(path))
+        return _archives[path]
+
+
+def splitMemberPath(path: str) -> T.Optional[T.Tuple[ArchiveIndex, str]]:
+    '''If the path is of an archive member, return the archive and its name.'''
+    path = os.path.abspath(path)
+    parent = path
+    while True:
+        parent, _ = os.path.split(parent)
+        if isArchive(parent):
+            name = os.path.relpath(path, parent).replace(os.sep, '/')
+            return openArchive(parent), name
+        if parent == os.path.dirname(parent):
+            return None
@@ -0,0 +1,136 @@
+#-*- coding: utf-8 -*-
+'''
+Read-ahead cache of raw (compressed) image bytes. This sits below the small
+cache of decoded pixmaps in the UI, so that on slow storage the fetching of
+upcoming files is already done by the time we want to decode them.
+'''
+from collections import OrderedDict
+from functools import partial
+import logging
+import threading
+import typing as T
+
+from imagepicker.utils import readImageBytes
+
+
+class ByteCache:
+    '''Keep the bytes of recently-seen and upcoming files in memory.
+
+    A single background thread works through the read-ahead list in order --
+    one reader doing large sequential reads is kinder to network storage than
+    many doing small ones.
+    '''
+
+    def __init__(self, budget: int=256 * 1024 * 1024,
+                 reader: T.Callable[[str], bytes]=None,
+                 logger: logging.Logger=None) -> None:
+        self.budget = budget
+        self.logger = logger or logging.getLogger(__name__)
+        # nothing bigger than the whole budget gets inflated out of an archive
+        self._reader = reader or partial(readImageBytes, maxSize=budget)
+        self._entries = OrderedDict()  # type: T.Dict[str, bytes]
+        self._size = 0
+        self._pending = []  # type: T.List[str]
+        self._wanted = set()  # type: T.Set[str]
+        # the file the read-ahead is reading now, and the last one it read --
+        # kept even if it didn't fit, for anyone who was waiting on it
+        self._reading = None  # type: T.Optional[str]
+        self._lastRead = None  # type: T.Optional[T.Tuple[str, bytes]]
+        self._lock = threading.Condition()
+        self._thread = threading.Thread(target=self._readAhead, daemon=True,
+                                        name='ByteCache')
+        self._thread.start()
+
+    def get(self, filename: str) -> bytes:
+        '''Return the file's bytes, reading them now if we don't have them.
+
+        If the read-ahead is part way through reading the file, we wait for it
+        rather than starting another read of the same thing.
+        '''
+        with self._lock:
+            while filename == self._reading:
+                self._lock.wait()
+            data = self._entries.get(filename)
+            if data is not None:
+                self._entries.move_to_end(filename)
+                return data
+            if self._lastRead and self._lastRead[0] == filename:
+                return self._lastRead[1]
+
+        data = self._reader(filename)
+        with self._lock:
+            self._store(filename, data)
+        return data
+
+    def prefetch(self, filenames: T.Sequence[str]) -> None:
+        '''Read the given files ahead of time, most urgent first.
+
+        This replaces any read-ahead still outstanding, so skipped-over files
+        are not fetched.
+        '''
+        with self._lock:
+            self._wanted = set(filenames)
+            self._pending = [f for f in reversed(filenames)
+                             if f not in self._entries]
+            self._lock.notify_all()
+
+    def cancel(self) -> None:
+        '''Drop any outstanding read-ahead.'''
+        self.prefetch([])
+
+    def __contains__(self, filename: str) -> bool:
+        with self._lock:
+            return filename in self._entries
+
+    def _store(self, filename: str, data: bytes) -> bool:
+        '''Add to the cache, evicting as needed. Call with the lock held.'''
+        if filename in self._entries:
+            return True
+        if len(data) > self.budget:
+            return False
+
+        # evict least-recently-used entries, but never ones we're reading
+        # ahead for -- if it's all wanted, the read-ahead has to stop here
+        for victim in list(self._entries):
+            if self._size + len(data) <= self.budget:
+                break
+            if victim in self._wanted:
+                continue
+            self._size -= len(self._entries.pop(victim))
+        if self._size + len(data) > self.budget:
+            return False
+
+        self._entries[filename] = data
+        self._size += len(data)
+        return True
+
+    def _readAhead(self) -> None:
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._lock.wait()
+                filename = self._pending.pop()
+                if filename in self._entries:
+                    continue
+                self._reading = filename
+
+            data = None
+            try:
+                data = self._reader(filename)
+            # whatever went wrong, this thread has to carry on
+            except Exception as e:  # pylint: disable=broad-except
+                # let a waiting get() read it, and see the error, itself
+                self.logger.debug('read-ahead of %s failed: %s', filename, e)
+            finally:
+                with self._lock:
+                    self._reading = None
+                    self._lastRead = ((filename, data) if data is not None
+                                      else None)
+                    self._lock.notify_all()
+
+            with self._lock:
+                if data is None:
+                    continue
+                if filename in self._wanted and not self._store(filename, data):
+                    # out of budget -- wait for the window to move on
+                    self._pending = []
@@ -0,0 +1,241 @@
+#-*- coding: utf-8 -*-
+'''
+Image decoding backends. Qt's own decoders always work, but others (Pillow on
+libjpeg-turbo, say) can be a lot quicker for some formats -- so each format is
+benchmarked on the first image we see of it, at full size and reduced, and the
+fastest backend for each is used from then on.
+'''
+import io
+import logging
+import sys
+import threading
+import time
+import typing as T
+
+from PyQt5.QtCore import Qt, QBuffer, QByteArray, QSize
+from PyQt5.QtGui import QImage, QImageReader
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+
+logger = logging.getLogger(__name__)
+
+# leading bytes identifying the formats we know how to pick decoders for
+_SIGNATURES = [(b'\xff\xd8', 'jpeg'), (b'\x89PNG', 'png'), (b'GIF8', 'gif'),
+               (b'BM', 'bmp'), (b'II*\x00', 'tiff'), (b'MM\x00*', 'tiff')]
+
+# the 32-bit layouts QImage uses are native-endian words, so the byte order
+# in memory depends on the machine
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def sniffFormat(data: bytes) -> str:
+    '''Guess the image format from its first few bytes.'''
+    for signature, fmt in _SIGNATURES:
+        if data[:len(signature)] == signature:
+            return fmt
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return ''
+
+
+class Decoder:
+    '''Turns image bytes into a QImage.
+
+    If `size` is given, the decoder may return an image reduced to anything
+    no smaller than fits in it -- whatever is cheapest.
+    '''
+    name = ''
+    # formats this decoder handles, or None for anything
+    formats = None  # type: T.Optional[T.Set[str]]
+
+    @staticmethod
+    def available() -> bool:
+        return True
+
+    def handles(self, fmt: str) -> bool:
+        return self.formats is None or fmt in self.formats
+
+    def decode(self, data: bytes, size: QSize=None) -> QImage:
+        raise NotImplementedError
+
+
+class QtDecoder(Decoder):
+    '''Qt's own image plugins.'''
+    name = 'qt'
+
+    def decode(self, data: bytes, size: QSize=None) -> QImage:
+        # the reader only borrows the buffer, so hang on to it ourselves
+        array = QByteArray(data)
+        buf = QBuffer(array)
+        reader = QImageReader(buf)
+        if size is not None:
+            full = reader.size()
+            if full.isValid():
+                reader.setScaledSize(full.scaled(size, Qt.KeepAspectRatio))
+        return reader.read()
+
+
+class PillowDecoder(Decoder):
+    '''Pillow, using JPEG draft mode for reduced-size decodes.'''
+    name = 'pillow'
+    formats = {'jpeg', 'png', 'gif', 'bmp', 'tiff', 'webp'}
+
+    @staticmethod
+    def available() -> bool:
+        return Image is not None
+
+    def decode(self, data: bytes, size: QSize=None) -> QImage:
+        img = Image.open(io.BytesIO(data))
+        if size is not None:
+            img.draft('RGB', (size.width(), size.height()))
+
+        # have Pillow's raw encoder lay the pixels out as QImage's native
+        # 32-bit words, so that this is the only copy made
+        if 'A' in img.getbands():
+            if img.mode != 'RGBA':
+                img = img.convert('RGBA')
+            layout = 'BGRA' if _LITTLE_ENDIAN else 'ARGB'
+            fmt = QImage.Format_ARGB32
+        else:
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            layout = 'BGRX' if _LITTLE_ENDIAN else 'XRGB'
+            fmt = QImage.Format_RGB32
+        raw = img.tobytes('raw', layout)
+        return wrapPixels(raw, img.width, img.height, img.width * 4, fmt)
+
+
+class TurboJPEGDecoder(Decoder):
+    '''libjpeg-turbo directly, through PyTurboJPEG.'''
+    name = 'turbojpeg'
+    formats = {'jpeg'}
+    _jpeg = None
+
+    @staticmethod
+    def available() -> bool:
+        return turbojpeg is not None
+
+    def decode(self, data: bytes, size: QSize=None) -> QImage:
+        if self._jpeg is None:
+            TurboJPEGDecoder._jpeg = turbojpeg.TurboJPEG()
+
+        scale = (1, 1)
+        if size is not None:
+            width, height, _, _ = self._jpeg.decode_header(data)
+            # the smallest of libjpeg's scaled IDCTs that's still big enough
+            for num, denom in sorted(self._jpeg.scaling_factors,
+                                     key=lambda f: f[0] / f[1]):
+                if (width * num // denom >= size.width()
+                        or height * num // denom >= size.height()):
+                    scale = (num, denom)
+                    break
+
+        pixelFormat = (turbojpeg.TJPF_BGRX if _LITTLE_ENDIAN
+                       else turbojpeg.TJPF_XRGB)
+        pixels = self._jpeg.decode(data, pixel_format=pixelFormat,
+                                   scaling_factor=scale)
+        height, width = pixels.shape[:2]
+        return wrapPixels(pixels.data, width, height, pixels.strides[0],
+                          QImage.Format_RGB32)
+
+
+def wrapPixels(buffer: T.Any, width: int, height: int, bytesPerLine: int,
+               fmt: QImage.Format) -> QImage:
+    '''Make a QImage over the decoded pixels, without copying them.'''
+    image = QImage(buffer, width, height, bytesPerLine, fmt)
+    # the QImage doesn't own the pixels, so keep them alive alongside it
+    image._buffer = buffer
+    return image
+
+
+DECODERS = {}  # type: T.Dict[str, Decoder]
+# by format, and whether the decode is reduced-size
+_chosen = {}  # type: T.Dict[T.Tuple[str, bool], Decoder]
+_chooseLock = threading.Lock()
+
+
+def registerDecoder(decoder: Decoder) -> None:
+    '''Make a decoder available, if its dependencies are installed.'''
+    if decoder.available():
+        DECODERS[decoder.name] = decoder
+        _chosen.clear()
+
+
+for _decoder in (QtDecoder(), PillowDecoder(), TurboJPEGDecoder()):
+    registerDecoder(_decoder)
+
+
+def benchmark(data: bytes, fmt: str=None, size: QSize=None,
+              repeats: int=3) -> T.Dict[str, float]:
+    '''Time each decoder that handles the format on this image, optionally
+    reduced to fit `size`.
+
+    Returns the best time for each decoder that managed to decode it.
+    '''
+    fmt = sniffFormat(data) if fmt is None else fmt
+    timings = {}
+    for name, decoder in DECODERS.items():
+        if not decoder.handles(fmt):
+            continue
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            try:
+                image = decoder.decode(data, size)
+            except Exception:  # pylint: disable=broad-except
+                image = None
+            elapsed = time.perf_counter() - start
+            if image is None or image.isNull():
+                break
+            best = elapsed if best is None else min(best, elapsed)
+        if best is not None:
+            timings[name] = best
+    return timings
+
+
+def chooseDecoder(data: bytes, fmt: str, size: QSize=None) -> Decoder:
+    '''The fastest decoder for the format, benchmarking it on `data` if needed.
+
+    Reduced-size decodes are benchmarked separately -- draft modes and scaled
+    IDCTs can change which backend is quickest.
+    '''
+    key = (fmt, size is not None)
+    with _chooseLock:
+        if key not in _chosen:
+            timings = benchmark(data, fmt, size)
+            name = min(timings, key=timings.get) if timings else QtDecoder.name
+            logger.info('decoding %s%s with %s (timings: %s)',
+                        fmt or 'unknown formats',
+                        ' reduced' if size is not None else '', name, timings)
+            _chosen[key] = DECODERS[name]
+        return _chosen[key]
+
+
+def decodeImage(data: bytes, size: QSize=None,
+                decoderName: str=None) -> QImage:
+    '''Decode with the fastest backend, falling back on Qt if that fails.
+
+    Passing `decoderName` skips choosing one, e.g. where the choice has already
+    been made in another process.
+    '''
+    if decoderName is not None:
+        decoder = DECODERS.get(decoderName, DECODERS[QtDecoder.name])
+    else:
+        decoder = chooseDecoder(data, sniffFormat(data), size)
+    try:
+        image = decoder.decode(data, size)
+    except Exception as e:  # pylint: disable=broad-except
+        logger.debug('%s decoder failed: %s', decoder.name, e)
+        image = None
+    if (image is None or image.isNull()) and decoder.name != QtDecoder.name:
+        image = DECODERS[QtDecoder.name].decode(data, size)
+    return image
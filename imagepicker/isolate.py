@@ -0,0 +1,285 @@
+#-*- coding: utf-8 -*-
+'''
+Decoding in supervised worker processes, so that a truncated file or a
+decompression bomb can't hang the UI or eat all the memory -- the worker just
+gets killed, and we move on.
+
+Decoded pixels come back through shared memory, which the image wraps
+directly, rather than being copied through the pipe.
+'''
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import queue
+import threading
+import typing as T
+
+from PyQt5.QtCore import QBuffer, QByteArray, QSize
+from PyQt5.QtGui import QImage, QImageReader
+
+from imagepicker.decoders import (chooseDecoder, decodeImage, sniffFormat,
+                                  wrapPixels)
+
+
+class DecodeError(Exception):
+    '''The image couldn't be decoded.'''
+
+
+class DecodeTimeout(DecodeError):
+    '''Decoding the image took too long, so the worker was killed.'''
+
+
+class WorkerUnavailable(Exception):
+    '''A decoding process couldn't be started -- no fault of the image's.'''
+
+
+def limitMemory(limit: int) -> None:
+    '''Cap this process's address space, where the platform lets us.'''
+    try:
+        import resource
+    except ImportError:
+        return
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _checkPixels(data: bytes, maxPixels: int) -> None:
+    '''Check the header before committing to a decode, to catch bombs early.'''
+    array = QByteArray(data)
+    buf = QBuffer(array)
+    full = QImageReader(buf).size()
+    if full.isValid() and full.width() * full.height() > maxPixels:
+        raise DecodeError('{}x{} is too many pixels'.format(
+            full.width(), full.height()))
+
+
+def _decodeForTransfer(data: bytes, size: T.Optional[T.Tuple[int, int]],
+                       decoderName: str, maxPixels: int) -> QImage:
+    _checkPixels(data, maxPixels)
+    image = decodeImage(data, QSize(*size) if size else None, decoderName)
+    if image.isNull():
+        raise DecodeError('not a readable image')
+
+    # only the raw pixels go back, so there mustn't be a colour table
+    if image.hasAlphaChannel():
+        return image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+    return image.convertToFormat(QImage.Format_RGB32)
+
+
+def _chooseForTransfer(data: bytes, size: T.Optional[T.Tuple[int, int]],
+                       maxPixels: int) -> str:
+    _checkPixels(data, maxPixels)
+    return chooseDecoder(data, sniffFormat(data),
+                         QSize(*size) if size else None).name
+
+
+def _serve(conn: T.Any, memoryLimit: int, maxPixels: int) -> None:
+    '''Worker process: handle whatever we're sent until the pipe closes.
+
+    That's ('decode', data, size, decoderName), answered with the decoded
+    pixels, or ('benchmark', data, size), answered with the fastest decoder's
+    name -- either way under this process's limits.
+    '''
+    limitMemory(memoryLimit)
+    # starting up (and importing Qt) can take a while, so say when we're ready
+    # rather than have the first decode's time limit cover it
+    conn.send(('ready',))
+    while True:
+        try:
+            request, data, size, *rest = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            if request == 'benchmark':
+                conn.send(('ok', _chooseForTransfer(data, size, maxPixels)))
+                continue
+            image = _decodeForTransfer(data, size, rest[0], maxPixels)
+            name = _share(image)
+        except (DecodeError, MemoryError, ValueError, OSError) as e:
+            conn.send(('error', '{}: {}'.format(type(e).__name__, e)))
+            continue
+
+        conn.send(('ok', image.width(), image.height(),
+                   image.bytesPerLine(), int(image.format()), name))
+
+
+def _share(image: QImage) -> str:
+    '''Copy the pixels into a new shared memory block, and return its name.
+
+    The block is the receiver's to unlink, so we don't track it here -- or it
+    would be cleaned up from under them when we exit.
+    '''
+    size = image.byteCount()
+    block = shared_memory.SharedMemory(create=True, size=size)
+    resource_tracker.unregister(block._name, 'shared_memory')  # pylint: disable=protected-access
+    bits = image.constBits()
+    bits.setsize(size)
+    block.buf[:size] = bits
+    block.close()
+    return block.name
+
+
+def _attach(name: str, width: int, height: int, bytesPerLine: int,
+            fmt: QImage.Format) -> QImage:
+    '''Wrap the pixels a worker left in shared memory, without copying them.'''
+    block = shared_memory.SharedMemory(name=name)
+    # the mapping outlives the name, so it can go as soon as we've opened it
+    block.unlink()
+    image = wrapPixels(block.buf, width, height, bytesPerLine, fmt)
+    # and the mapping itself lives as long as the image does
+    image._sharedMemory = block
+    return image
+
+
+def _dims(size: T.Optional[QSize]) -> T.Optional[T.Tuple[int, int]]:
+    # QSize doesn't pickle, so it goes over the pipe as a tuple
+    return (size.width(), size.height()) if size else None
+
+
+class _Worker:
+    def __init__(self, context: T.Any, memoryLimit: int,
+                 maxPixels: int) -> None:
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_serve, daemon=True,
+                                       args=(child, memoryLimit, maxPixels),
+                                       name='ImagePicker decoder')
+        self.process.start()
+        child.close()
+        self.killed = False
+
+    def kill(self) -> None:
+        self.killed = True
+        self.process.terminate()
+        self.process.join(1)
+        self.conn.close()
+
+
+class DecoderPool:
+    '''A small pool of decoding processes, each with a time and memory limit.
+
+    A worker that runs over its time, or dies, is killed and replaced, and
+    the decode raises a DecodeError rather than taking us down with it.
+    Decodes are submitted from a thread per worker, so they all run at once
+    and the caller never waits on one.
+
+    Which backend to decode with is benchmarked once per format, in a worker
+    like any decode, and only its name kept here to send along with each
+    image -- so the benchmark runs under the same limits, but the workers
+    don't each repeat it.
+    '''
+
+    # seconds for a new worker to start up
+    startupTimeout = 60.0
+    # seconds for a worker to benchmark the decoders, which decodes the
+    # image a few times over
+    benchmarkTimeout = 60.0
+
+    def __init__(self, workers: int=2, timeout: float=10.0,
+                 memoryLimit: int=2 * 1024 ** 3,
+                 maxPixels: int=250 * 1000 ** 2,
+                 logger: logging.Logger=None) -> None:
+        self.timeout = timeout
+        self.memoryLimit = memoryLimit
+        self.maxPixels = maxPixels
+        self.logger = logger or logging.getLogger(__name__)
+        # spawned rather than forked, since we're a threaded Qt application
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = queue.Queue()  # type: queue.Queue
+        for _ in range(workers):
+            self._idle.put(None)  # started on first use
+        self._threads = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='DecoderPool')
+        # decoder names by format, and whether the decode is reduced-size
+        self._choices = {}  # type: T.Dict[T.Tuple[str, bool], str]
+        self._choicesLock = threading.Lock()
+
+    def _spawn(self) -> _Worker:
+        worker = _Worker(self._context, self.memoryLimit, self.maxPixels)
+        try:
+            ready = worker.conn.poll(self.startupTimeout)
+            if ready:
+                worker.conn.recv()
+        except (EOFError, OSError):
+            ready = False
+        if not ready:
+            worker.kill()
+            raise WorkerUnavailable('decoder process did not start')
+        return worker
+
+    def submit(self, read: T.Callable[[], bytes],
+               size: QSize=None) -> 'Future[QImage]':
+        '''Decode in the background, returning a future for the image.
+
+        `read` fetches the image's bytes, and is called on the pool's own
+        thread, so that slow storage doesn't hold the caller up either.
+        '''
+        return self._threads.submit(lambda: self.decode(read(), size))
+
+    def decode(self, data: bytes, size: QSize=None) -> QImage:
+        '''Decode the image in a worker, optionally reduced to fit `size`.'''
+        _checkPixels(data, self.maxPixels)
+        worker = self._idle.get()
+        try:
+            worker = worker or self._spawn()
+            decoderName = self._chooseWith(worker, data, size)
+            image = self._decodeWith(worker, data, size, decoderName)
+        except DecodeError:
+            # even if it looks alive still, it can't be used again
+            if worker.killed:
+                worker = None
+            raise
+        finally:
+            self._idle.put(worker)
+        return image
+
+    def _chooseWith(self, worker: _Worker, data: bytes,
+                    size: T.Optional[QSize]) -> str:
+        '''The decoder to use for this format, having `worker` benchmark them
+        on this image if we haven't yet.'''
+        key = (sniffFormat(data), size is not None)
+        with self._choicesLock:
+            name = self._choices.get(key)
+        if name is None:
+            # two workers might race to benchmark the same format, but the
+            # lock isn't held meanwhile, so nothing else waits on it
+            _, name = self._request(worker, ('benchmark', data, _dims(size)),
+                                    self.benchmarkTimeout)
+            self.logger.info('decoding %s%s with %s',
+                             key[0] or 'unknown formats',
+                             ' reduced' if key[1] else '', name)
+            with self._choicesLock:
+                name = self._choices.setdefault(key, name)
+        return name
+
+    def _decodeWith(self, worker: _Worker, data: bytes,
+                    size: T.Optional[QSize], decoderName: str) -> QImage:
+        _, width, height, bytesPerLine, fmt, name = self._request(
+            worker, ('decode', data, _dims(size), decoderName), self.timeout)
+        return _attach(name, width, height, bytesPerLine, QImage.Format(fmt))
+
+    def _request(self, worker: _Worker, message: tuple,
+                 timeout: float) -> tuple:
+        '''Send `worker` a request, and wait up to `timeout` for its reply.'''
+        try:
+            worker.conn.send(message)
+            if not worker.conn.poll(timeout):
+                self.logger.warning('decoder timed out, restarting it')
+                worker.kill()
+                raise DecodeTimeout('gave up after {}s'.format(timeout))
+            reply = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            # most likely killed for going over its memory limit
+            self.logger.warning('decoder died (%s), restarting it', e)
+            worker.kill()
+            raise DecodeError('decoder process died ({})'.format(e))
+        if reply[0] == 'error':
+            raise DecodeError(reply[1])
+        return reply
+
+    def close(self) -> None:
+        self._threads.shutdown(wait=False)
+        while not self._idle.empty():
+            worker = self._idle.get_nowait()
+            if worker is not None:
+                worker.kill()
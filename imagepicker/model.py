@@ -3,11 +3,23 @@
 Holding the state for the application.
 '''
 import os
-from os.path import join, abspath, relpath, exists, isdir, islink, isabs, basename
+from os.path import (join, abspath, relpath, exists, lexists, isdir, isfile,
+                     islink, isabs, basename, dirname)
+import shutil
 import typing as T
 
 from ruamel.yaml import YAML
-from imagepicker.utils import listImageFiles, setPDBTrace
+from imagepicker.utils import (listAlbumFiles, isImageFile, isAlbumDirectory,
+                               setPDBTrace)
+from imagepicker.archive import isArchive, openArchive, splitMemberPath
+from imagepicker.partition import Chunk, ChunkQueue, lockedFile
+from imagepicker.search import PathIndex
+from imagepicker.analysis import Scores, isLikelyReject
+from imagepicker.watch import TreeSnapshot
+
+
+# settings files that can be opened as a list of everything picked so far
+PICK_LIST_EXTENSIONS = ('.yml', '.yaml')
 
 
 # TODO: we're going to need caching and such to see how many things are
@@ -19,38 +31,218 @@ class PickerModel:
 
     albums: T.Dict[str, str]
     inputDir: str
+    # for an archive, its file name -- input paths are relative to it, and it
+    # is relative to `inputDir`, where new albums go
+    memberPrefix: str = ''
     inputFiles: T.List[str]
+    allFiles: T.List[str]
     settingsFile: str
     current: int
+    index: PathIndex
+    # the directory tree we're showing, if the input is one (and not an album)
+    treeRoot: T.Optional[str] = None
+    # what was in it when we listed it, to start watching it from
+    treeSnapshot: T.Optional[TreeSnapshot] = None
+    # sharpness/exposure scores by full path, as far as analysis has got
+    scores: T.Dict[str, Scores]
+    skipRejects: bool = False
+    # files that couldn't be decoded, by full path, with the reason why
+    badFiles: T.Dict[str, str]
+
+    # when sharing the tree with other reviewers, we only see one chunk of
+    # `allFiles` at a time
+    partition: T.Optional[ChunkQueue] = None
+    chunk: T.Optional[Chunk] = None
+    reviewer: T.Optional[str] = None
 
     def __init__(self, settingsFile: str, inputDirectory: str) -> None:
         '''Initialize the model.'''
         self.current = 0
+        self.settingsFile = settingsFile
+        self._removedAlbums = set()  # type: T.Set[str]
+        self.scores = {}
+        self.badFiles = {}
 
-        self.loadDirectory(inputDirectory)
+        self.loadInput(inputDirectory)
         self.loadSettings(settingsFile)
 
-    def loadSettings(self, settingsPath: str) -> None:
-        self.settingsFile = settingsPath
+    @staticmethod
+    def _readSettings(settingsPath: str) -> T.Dict[str, T.Any]:
+        if not exists(settingsPath):
+            return {'albums': {}}
 
-        if exists(settingsPath):
-            yaml = YAML(typ='safe')
-            with open(settingsPath, 'r') as f:
-                contents = yaml.load(f)
+        yaml = YAML(typ='safe')
+        with open(settingsPath, 'r') as f:
+            contents = yaml.load(f)
 
-            if 'albums' not in contents:
-                raise AssertionError('Settings file not correctly formatted!')
-        else:
-            contents = {'albums': {}}
+        if not contents or 'albums' not in contents:
+            raise AssertionError('Settings file not correctly formatted!')
+        return contents
+
+    def loadSettings(self, settingsPath: str) -> None:
+        self.settingsFile = settingsPath
+        contents = self._readSettings(settingsPath)
 
         self.albums = {}
         for name, path in contents['albums'].items():
             self.addAlbum(name, path)
 
+    def loadInput(self, path: str) -> None:
+        '''Load image list from a directory tree, an archive, an album or a
+        settings file.'''
+        if isArchive(path):
+            self.loadDirectory(path)
+        elif isfile(path):
+            if not path.lower().endswith(PICK_LIST_EXTENSIONS):
+                raise ValueError('{}: not a directory, archive or YAML pick '
+                                 'list'.format(path))
+            self.loadPickList(path)
+        elif isAlbumDirectory(path):
+            self.loadAlbum(path)
+        else:
+            self.loadDirectory(path)
+
     def loadDirectory(self, dirname: str) -> None:
-        '''Load image list from a directory tree.'''
-        self.inputDir = dirname
-        self.inputFiles = list(listImageFiles(dirname))
+        '''Load image list from a directory tree, or a ZIP or TAR archive.
+
+        Archive members are listed as if the archive were a directory, so
+        they're read (and picked) as paths inside it.
+        '''
+        self._leavePartition()
+        if isArchive(dirname):
+            archive = openArchive(dirname)
+            self.inputDir, self.memberPrefix = os.path.split(abspath(dirname))
+            self.treeRoot = self.treeSnapshot = None
+            self.allFiles = [n for n in archive.names if isImageFile(n)]
+        else:
+            self.inputDir, self.memberPrefix = dirname, ''
+            # listed through the snapshot, so watching the tree for changes
+            # doesn't need to walk it all over again
+            self.treeRoot = dirname
+            self.treeSnapshot = TreeSnapshot(dirname)
+            self.treeSnapshot.scan()
+            self.allFiles = sorted(self.treeSnapshot.files())
+        self._setInputFiles(self.allFiles)
+
+    def loadAlbum(self, albumPath: str) -> None:
+        '''Load image list from the pictures already in an album.
+
+        This only reads the album itself, not the tree it was picked from, so
+        further filtering of a small album starts straight away.
+        '''
+        self._leavePartition()
+        # albums given relative paths from here end up beside this one
+        self.inputDir, self.memberPrefix = dirname(abspath(albumPath)), ''
+        self.treeRoot = self.treeSnapshot = None
+        self.allFiles = sorted(listAlbumFiles(albumPath))
+        self._setInputFiles(self.allFiles)
+
+    def loadPickList(self, settingsPath: str) -> None:
+        '''Load image list from all the albums in a settings file.'''
+        albums = self._readSettings(settingsPath)['albums']
+        self._leavePartition()
+        self.inputDir, self.memberPrefix = dirname(abspath(settingsPath)), ''
+        self.treeRoot = self.treeSnapshot = None
+
+        files = set()  # type: T.Set[str]
+        for albumPath in albums.values():
+            if not isabs(albumPath):
+                albumPath = join(self.inputDir, albumPath)
+            if isdir(albumPath):
+                files.update(listAlbumFiles(albumPath))
+        self.allFiles = sorted(files)
+        self._setInputFiles(self.allFiles)
+
+    def sharePartition(self, queuePath: str, reviewer: str,
+                       chunkSize: int=500) -> bool:
+        '''Work on chunks of the input handed out through a shared queue.
+
+        Returns False if there was nothing left to claim -- in which case we
+        only see the chunks this reviewer has already done, if any, so as not
+        to tread on anyone else's.
+        '''
+        self._leavePartition()
+        # everyone has to agree on the order for the chunks to mean anything
+        self.allFiles.sort()
+        try:
+            self.partition = ChunkQueue(queuePath, self.allFiles, chunkSize)
+        except BaseException:
+            # carry on with the whole tree, as (re-)sorted
+            self._setInputFiles(self.allFiles)
+            raise
+        self.reviewer = reviewer
+        if self.claimNextChunk():
+            return True
+
+        ownFiles = []  # type: T.List[str]
+        for chunk in self.partition.claimedBy(reviewer):
+            ownFiles.extend(self.allFiles[chunk.start:chunk.stop])
+        self._setInputFiles(ownFiles)
+        return False
+
+    def claimNextChunk(self) -> bool:
+        '''Finish the current chunk (if any) and move on to the next one.'''
+        if not self.partition:
+            return False
+
+        if self.chunk:
+            self.partition.complete(self.chunk)
+        chunk = self.partition.claim(self.reviewer)
+        if not chunk:
+            return False
+
+        self.chunk = chunk
+        self._setInputFiles(self.allFiles[chunk.start:chunk.stop])
+        return True
+
+    def heartbeat(self) -> None:
+        '''Keep our chunk from looking abandoned -- call every so often.'''
+        if self.chunk:
+            self.partition.heartbeat(self.chunk, self.reviewer)
+
+    def _leavePartition(self) -> None:
+        if not self.partition:
+            return
+
+        if self.chunk:
+            self.partition.release(self.chunk)
+        self.partition.close()
+        self.partition = self.chunk = self.reviewer = None
+
+    def applyChanges(self, added: T.Sequence[str],
+                     removed: T.Sequence[str]) -> bool:
+        '''Add and remove files in place, keeping our position in the list.
+
+        New files go on the end. Returns True if the current file was removed.
+        '''
+        # chunks are laid out over the list as it was, and other reviewers
+        # have to agree with us on that
+        if self.partition:
+            return False
+
+        currentRemoved = False
+        if removed:
+            gone = set(removed)
+            currentRemoved = (bool(self.inputFiles)
+                              and self.inputFiles[self.current] in gone)
+            before = sum(1 for f in self.inputFiles[:self.current] if f in gone)
+            # a new list rather than in place, as the index may still be
+            # building over the old one
+            self.allFiles = [f for f in self.allFiles if f not in gone]
+            self.inputFiles = self.allFiles
+            self.index = PathIndex(self.inputFiles)
+            self.current = max(0, min(self.current - before,
+                                      len(self.inputFiles) - 1))
+
+        if added:
+            self.inputFiles.extend(added)
+            self.index.update()
+        return currentRemoved
+
+    def _setInputFiles(self, files: T.List[str]) -> None:
+        self.inputFiles = files
+        self.index = PathIndex(files)
+        self.current = 0
 
     def addAlbum(self, name: str, dirname: str) -> None:
         if not isabs(dirname):
@@ -58,12 +250,14 @@ class PickerModel:
         if not isdir(dirname):
             os.makedirs(dirname)
         self.albums[name] = dirname
+        self._removedAlbums.discard(name)
         self.save()
 
     def removeAlbum(self, name: str) -> None:
         # TODO: Do we clear out the directory when we remove the album?
         if name in self.albums:
             del self.albums[name]
+        self._removedAlbums.add(name)
         self.save()
 
     def isPicked(self, album: str, filename: str=None):
@@ -81,7 +275,7 @@ class PickerModel:
 
         try:
             albumPath = self.albums[album]
-            filePath = filename if isabs(filename) else abspath(join(self.inputDir, filename))
+            filePath = self._fullPath(filename)
             baseFileName = basename(filename)
             os.symlink(filePath, join(albumPath, baseFileName))
         except FileExistsError:
@@ -94,7 +288,8 @@ class PickerModel:
 
         baseFileName = basename(filename)
         filePath = abspath(join(self.albums[album], baseFileName))
-        if not exists(filePath):
+        # links to archive members are always dangling, so don't follow them
+        if not lexists(filePath):
             return
 
         try:
@@ -111,14 +306,50 @@ class PickerModel:
         else:
             self.pick(album, filename)
 
+    def exportAlbum(self, name: str, destination: str) -> int:
+        '''Copy an album's pictures out as real files, returning how many.
+
+        Pictures picked from archives are streamed out of them.
+        '''
+        os.makedirs(destination, exist_ok=True)
+        count = 0
+        for path in listAlbumFiles(self.albums[name]):
+            target = join(destination, basename(path))
+            found = None if exists(path) else splitMemberPath(path)
+            if found:
+                archive, member = found
+                with open(target, 'wb') as f:
+                    for chunk in archive.iterMember(member):
+                        f.write(chunk)
+            elif exists(path):
+                shutil.copyfile(path, target)
+            else:
+                continue
+            count += 1
+        return count
+
     def save(self) -> None:
-        '''Write the album list to a YAML file.'''
+        '''Write the album list to a YAML file.
+
+        Other reviewers may be saving into the same file, so we merge our
+        albums into whatever's on disk rather than overwriting it.
+        '''
         if not self.settingsFile:
             return
 
-        yaml = YAML()
-        with open(self.settingsFile, 'w') as f:
-            yaml.dump({'albums': self.albums}, f)
+        with lockedFile(self.settingsFile):
+            albums = self._readSettings(self.settingsFile)['albums']
+            for name in self._removedAlbums:
+                albums.pop(name, None)
+            albums.update(self.albums)
+
+            yaml = YAML()
+            tmpFile = self.settingsFile + '.tmp'
+            with open(tmpFile, 'w') as f:
+                yaml.dump({'albums': albums}, f)
+            os.replace(tmpFile, self.settingsFile)
+        # done with these now -- someone else may re-add them later
+        self._removedAlbums.clear()
 
     @property
     def albumNames(self) -> T.List[str]:
@@ -126,7 +357,7 @@ class PickerModel:
 
     def _fullPath(self, filename: str) -> None:
         if not isabs(filename):
-            filename = abspath(join(self.inputDir, filename))
+            filename = abspath(join(self.inputDir, self.memberPrefix, filename))
 
         return filename
 
@@ -145,6 +376,19 @@ class PickerModel:
         '''What's the last file?'''
         return self._fullPath(self.inputFiles[(self.current - 1) % len(self.inputFiles)])
 
+    def upcomingFiles(self, count: int, direction: int=1) -> T.List[str]:
+        '''The next `count` files after the current one, wrapping around --
+        or the ones before it, if `direction` is negative.'''
+        total = len(self.inputFiles)
+        step = -1 if direction < 0 else 1
+        return [self._fullPath(self.inputFiles[(self.current + i * step) % total])
+                for i in range(1, min(count, total) + 1)]
+
+    @property
+    def inputPaths(self) -> T.List[str]:
+        '''Full paths of all the input files.'''
+        return [self._fullPath(f) for f in self.inputFiles]
+
     @property
     def count(self) -> int:
         '''How many files do we have in total?'''
@@ -154,14 +398,68 @@ class PickerModel:
         albumPath = self.albums[name]
         return len(os.listdir(albumPath))
 
+    def isLikelyReject(self, filename: str=None) -> bool:
+        '''Has analysis flagged the given (or current) file as a reject?'''
+        if not filename:
+            filename = self.currentFile
+        scores = self.scores.get(filename)
+        return scores is not None and isLikelyReject(scores)
+
+    def sortBySharpness(self) -> None:
+        '''Put the sharpest files first, and unscored ones last.'''
+        if not self.inputFiles:
+            return
+
+        currentFile = self.inputFiles[self.current]
+        noScore = Scores(-1.0, 0.0, 0.0)
+
+        def sharpness(filename: str) -> float:
+            return self.scores.get(self._fullPath(filename), noScore).sharpness
+
+        files = sorted(self.inputFiles, key=sharpness, reverse=True)
+        if self.inputFiles is self.allFiles:
+            self.allFiles = files
+        self._setInputFiles(files)
+        self.current = files.index(currentFile)
+
+    def markBad(self, filename: str, reason: str) -> None:
+        '''Remember that a file can't be shown, so we step over it from now on.'''
+        self.badFiles[filename] = reason
+
+    def _skipping(self) -> bool:
+        return (self.currentFile in self.badFiles
+                or (self.skipRejects and self.isLikelyReject()))
+
     def advance(self) -> None:
-        '''Step to the next file, wrapping around if we go over the end.'''
-        self.current += 1
-        if self.current >= len(self.inputFiles):
-            self.current = 0
+        '''Step to the next file, wrapping around if we go over the end.
+
+        When sharing the tree, going over the end of a chunk moves on to the
+        next unclaimed one instead, if there is one. Bad files, and likely
+        rejects if we're skipping them, are stepped over.
+        '''
+        for _ in range(len(self.inputFiles)):
+            self.current += 1
+            if self.current >= len(self.inputFiles):
+                if not self.claimNextChunk():
+                    self.current = 0
+            if not self._skipping():
+                break
+
+    def find(self, query: str, limit: int=100) -> T.List[int]:
+        '''Indices of files matching the query -- see `PathIndex.find`.'''
+        return self.index.find(query, limit)
+
+    def jumpTo(self, index: int) -> None:
+        '''Go straight to the given file.'''
+        if not 0 <= index < len(self.inputFiles):
+            raise IndexError('No file number {}'.format(index))
+        self.current = index
 
     def retreat(self) -> None:
         '''Step to previous file, wrapping around if we go past the start.'''
-        self.current -= 1
-        if self.current < 0:
-            self.current = len(self.inputFiles) - 1
+        for _ in range(len(self.inputFiles)):
+            self.current -= 1
+            if self.current < 0:
+                self.current = len(self.inputFiles) - 1
+            if not self._skipping():
+                break
@@ -0,0 +1,73 @@
+#-*- coding: utf-8 -*-
+'''
+Coalescing navigation, so that holding down an arrow key doesn't queue up a
+full redisplay for every image we pass on the way.
+'''
+import typing as T
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+
+class NavigationScheduler(QObject):
+    '''Move through the images straight away, but only render them in full
+    once the user stops.
+
+    While a key is auto-repeating, `previewRequested` is emitted at most once
+    per `previewInterval` for whichever image we've got to by then; images
+    passed over in between are never decoded at all. `settled` is emitted
+    when the key is released (or a single step is taken).
+    '''
+
+    previewRequested = pyqtSignal(int)
+    settled = pyqtSignal(int)
+
+    # milliseconds
+    previewInterval = 50
+    # in case we never see the key release, e.g. focus moved away mid-repeat
+    settleDelay = 250
+
+    def __init__(self, step: T.Callable[[int], int],
+                 parent: QObject=None) -> None:
+        '''`step` moves by the given amount, returning the new index.'''
+        super().__init__(parent)
+        self._step = step
+        self._current = 0
+        self._dirty = False
+        # which way we last moved: 1 forwards, -1 backwards
+        self.direction = 1
+
+        self._previewTimer = QTimer(self)
+        self._previewTimer.setSingleShot(True)
+        self._previewTimer.setInterval(self.previewInterval)
+        self._previewTimer.timeout.connect(self._preview)
+
+        self._settleTimer = QTimer(self)
+        self._settleTimer.setSingleShot(True)
+        self._settleTimer.setInterval(self.settleDelay)
+        self._settleTimer.timeout.connect(self.settle)
+
+    def move(self, delta: int, repeating: bool=False) -> None:
+        '''Step through the images -- `repeating` if the key's held down.'''
+        self._current = self._step(delta)
+        if delta:
+            self.direction = 1 if delta > 0 else -1
+        self._dirty = True
+        if not repeating:
+            self.settle()
+            return
+
+        if not self._previewTimer.isActive():
+            self._previewTimer.start()
+        self._settleTimer.start()
+
+    def settle(self) -> None:
+        '''We've stopped moving, so show where we are properly.'''
+        self._previewTimer.stop()
+        self._settleTimer.stop()
+        if self._dirty:
+            self._dirty = False
+            self.settled.emit(self._current)
+
+    def _preview(self) -> None:
+        if self._dirty:
+            self.previewRequested.emit(self._current)
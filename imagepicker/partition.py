@@ -0,0 +1,146 @@
+#-*- coding: utf-8 -*-
+'''
+Sharing one input tree between several reviewers -- the input list is split
+into chunks which are handed out through an SQLite database on the shared disk.
+'''
+import fcntl
+import hashlib
+import sqlite3
+import time
+import typing as T
+from contextlib import contextmanager
+
+
+Chunk = T.NamedTuple('Chunk', [('id', int), ('start', int), ('stop', int)])
+
+
+class ChunkQueue:
+    '''Hand out claimable chunks of a (sorted) input list.
+
+    Every reviewer must open the queue with the same file list; the first one
+    in lays out the chunks, and everyone after that just claims from them. A
+    digest of the list is kept to check that they do.
+    '''
+
+    # seconds without a heartbeat before a claimed chunk is up for grabs
+    # again -- its reviewer has probably crashed, or gone home
+    staleAfter = 30 * 60
+
+    def __init__(self, path: str, files: T.Sequence[str],
+                 chunkSize: int=500) -> None:
+        self.path = path
+        # isolation_level=None lets us manage transactions ourselves, so a
+        # claim can take the write lock up front with BEGIN IMMEDIATE
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta '
+                         '(key TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS chunks '
+                         '(id INTEGER PRIMARY KEY, start INTEGER, stop INTEGER,'
+                         ' reviewer TEXT, claimed REAL, done INTEGER DEFAULT 0)')
+        try:
+            self._layout(files, chunkSize)
+        except BaseException:
+            self._db.close()
+            raise
+
+    def _layout(self, files: T.Sequence[str], chunkSize: int) -> None:
+        count = len(files)
+        digest = hashlib.sha1('\0'.join(files).encode(
+            'utf-8', 'surrogateescape')).hexdigest()
+        with self._transaction() as db:
+            meta = dict(db.execute('SELECT key, value FROM meta'))
+            if meta:
+                if meta.get('digest') != digest:
+                    raise AssertionError(
+                        'Shared queue was laid out for a different list of '
+                        'files ({} of them, {} here) -- is everyone looking '
+                        'at the same tree?'.format(meta.get('count'), count))
+                return
+
+            db.executemany('INSERT INTO meta VALUES (?, ?)',
+                           [('count', str(count)), ('digest', digest)])
+            db.executemany('INSERT INTO chunks (start, stop) VALUES (?, ?)',
+                           [(i, min(i + chunkSize, count))
+                            for i in range(0, count, chunkSize)])
+
+    @contextmanager
+    def _transaction(self) -> T.Iterator[sqlite3.Connection]:
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._db
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        else:
+            self._db.execute('COMMIT')
+
+    def claim(self, reviewer: str) -> T.Optional[Chunk]:
+        '''Claim a chunk for the reviewer, or None if everything's taken.
+
+        A reviewer gets back a chunk it already holds (but hasn't finished)
+        before it's given a fresh one, so restarting doesn't leak chunks.
+        Unfinished chunks whose reviewer has gone quiet for `staleAfter` are
+        handed out again.
+        '''
+        with self._transaction() as db:
+            row = db.execute('SELECT id, start, stop FROM chunks '
+                             'WHERE reviewer = ? AND done = 0 ORDER BY id LIMIT 1',
+                             (reviewer,)).fetchone()
+            if not row:
+                row = db.execute('SELECT id, start, stop FROM chunks '
+                                 'WHERE reviewer IS NULL ORDER BY id LIMIT 1').fetchone()
+            if not row:
+                row = db.execute('SELECT id, start, stop FROM chunks '
+                                 'WHERE done = 0 AND claimed < ? ORDER BY id LIMIT 1',
+                                 (time.time() - self.staleAfter,)).fetchone()
+            if not row:
+                return None
+
+            db.execute('UPDATE chunks SET reviewer = ?, claimed = ? WHERE id = ?',
+                       (reviewer, time.time(), row[0]))
+        return Chunk(*row)
+
+    def heartbeat(self, chunk: Chunk, reviewer: str) -> None:
+        '''Show we're still working on the chunk, so it isn't thought stale.'''
+        with self._transaction() as db:
+            db.execute('UPDATE chunks SET claimed = ? '
+                       'WHERE id = ? AND reviewer = ?',
+                       (time.time(), chunk.id, reviewer))
+
+    def claimedBy(self, reviewer: str) -> T.List[Chunk]:
+        '''All the chunks the reviewer holds or has finished.'''
+        rows = self._db.execute('SELECT id, start, stop FROM chunks '
+                                'WHERE reviewer = ? ORDER BY id', (reviewer,))
+        return [Chunk(*row) for row in rows]
+
+    def complete(self, chunk: Chunk) -> None:
+        '''Mark a chunk as finished.'''
+        with self._transaction() as db:
+            db.execute('UPDATE chunks SET done = 1 WHERE id = ?', (chunk.id,))
+
+    def release(self, chunk: Chunk) -> None:
+        '''Give a chunk back, unfinished, for someone else to claim.'''
+        with self._transaction() as db:
+            db.execute('UPDATE chunks SET reviewer = NULL, claimed = NULL '
+                       'WHERE id = ? AND done = 0', (chunk.id,))
+
+    @property
+    def remaining(self) -> int:
+        '''How many chunks have not been claimed yet?'''
+        row = self._db.execute(
+            'SELECT COUNT(*) FROM chunks WHERE reviewer IS NULL').fetchone()
+        return row[0]
+
+    def close(self) -> None:
+        self._db.close()
+
+
+@contextmanager
+def lockedFile(path: str) -> T.Iterator[None]:
+    '''Hold an exclusive advisory lock beside `path` for the duration.'''
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,231 @@
+#-*- coding: utf-8 -*-
+'''
+Camera RAW files -- rather than demosaicing them, which is far too slow for
+picking through them, we pull out the full-size JPEG preview most cameras embed.
+
+Most RAW formats are TIFF underneath, so the preview can be found by walking
+the IFDs and reading only the byte ranges we need.
+'''
+import os
+import struct
+import typing as T
+
+
+RAW_EXTENSIONS = {'.arw', '.cr2', '.dng', '.nef', '.nrw', '.orf', '.pef',
+                  '.raf', '.rw2', '.sr2', '.srf', '.srw'}
+
+# TIFF tags we care about
+_COMPRESSION = 259
+_PHOTOMETRIC = 262
+_STRIP_OFFSETS = 273
+_STRIP_BYTE_COUNTS = 279
+_SUB_IFDS = 330
+_JPEG_OFFSET = 513
+_JPEG_LENGTH = 514
+_EXIF_IFD = 34665
+_MAKER_NOTE = 37500
+_CR2_SLICE = 50752
+_RW2_JPEG = 0x002E  # Panasonic's JpgFromRaw, a whole JPEG as one value
+
+# and in the maker notes, where the previews of ORF and PEF files live
+_OLYMPUS_CAMERA_SETTINGS = 0x2020
+_OLYMPUS_PREVIEW_START = 0x0101
+_OLYMPUS_PREVIEW_LENGTH = 0x0102
+_PENTAX_PREVIEW_LENGTH = 0x0003
+_PENTAX_PREVIEW_START = 0x0004
+
+# only these are worth reading the values of
+_IFD_TAGS = {_COMPRESSION, _PHOTOMETRIC, _STRIP_OFFSETS, _STRIP_BYTE_COUNTS,
+             _SUB_IFDS, _JPEG_OFFSET, _JPEG_LENGTH, _EXIF_IFD, _CR2_SLICE,
+             _RW2_JPEG}
+
+_JPEG_COMPRESSION = {6, 7}
+_RAW_PHOTOMETRIC = {32803, 34892}  # CFA, LinearRaw
+_UNDEFINED = 7
+_TYPE_SIZES = {1: 1, 3: 2, 4: 4, _UNDEFINED: 1, 13: 4}
+_TYPE_CODES = {1: 'B', 3: 'H', 4: 'I', 13: 'I'}
+_BYTE_ORDERS = {b'II': '<', b'MM': '>'}
+
+# the header magic, and which byte order it implies
+_TIFF_MAGIC = {b'II*\x00': '<', b'MM\x00*': '>',
+               b'IIRO': '<', b'IIRS': '<', b'MMOR': '>',  # Olympus
+               b'IIU\x00': '<'}  # Panasonic
+_FUJI_MAGIC = b'FUJIFILMCCD-RAW'
+
+# baseline, extended and progressive -- the lossless JPEG some cameras use for
+# the sensor data itself (SOF3) is no use to us
+_DISPLAYABLE_SOF = {0xC0, 0xC1, 0xC2}
+_MAX_IFDS = 64
+_HEAD_SIZE = 64 * 1024
+
+
+def isRawFile(filename: str) -> bool:
+    '''Is this a RAW file we should be extracting a preview from?'''
+    return os.path.splitext(filename)[1].lower() in RAW_EXTENSIONS
+
+
+def extractPreview(filename: str) -> bytes:
+    '''Return the bytes of the largest displayable JPEG embedded in the file.'''
+    with open(filename, 'rb') as f:
+        return extractPreviewFrom(f, filename)
+
+
+def extractPreviewFrom(f: T.BinaryIO, filename: str) -> bytes:
+    '''As `extractPreview`, from an already-open (seekable) file.'''
+    try:
+        candidates = _findCandidates(f)
+    except (struct.error, IndexError) as e:
+        raise ValueError('{}: malformed RAW file ({})'.format(filename, e))
+
+    for offset, length in sorted(candidates, key=lambda c: -c[1]):
+        # check the frame header before committing to reading it all
+        f.seek(offset)
+        head = f.read(min(length, _HEAD_SIZE))
+        if not _isDisplayableJPEG(head):
+            continue
+        data = head + f.read(length - len(head))
+        if len(data) == length:
+            return data
+
+    raise ValueError('{}: no embedded preview found'.format(filename))
+
+
+def _findCandidates(f: T.BinaryIO) -> T.List[T.Tuple[int, int]]:
+    header = f.read(16)
+    if header.startswith(_FUJI_MAGIC):
+        # Fuji's own container: the JPEG offset and length are at fixed spots
+        f.seek(84)
+        return [struct.unpack('>II', f.read(8))]
+
+    endian = _TIFF_MAGIC.get(header[:4])
+    if not endian:
+        raise ValueError('not a TIFF-based RAW file')
+
+    candidates = []
+    seen = set()  # type: T.Set[int]
+    queue = [struct.unpack(endian + 'I', header[4:8])[0]]
+    while queue and len(seen) < _MAX_IFDS:
+        offset = queue.pop(0)
+        if not offset or offset in seen:
+            continue
+        seen.add(offset)
+
+        tags, nextIFD = _readIFD(f, endian, offset, _IFD_TAGS)
+        queue.append(nextIFD)
+        queue.extend(tags.get(_SUB_IFDS, []))
+        candidates.extend(_previewsIn(tags))
+        if _EXIF_IFD in tags:
+            exif, _ = _readIFD(f, endian, tags[_EXIF_IFD][0], {_MAKER_NOTE})
+            if _MAKER_NOTE in exif:
+                candidates.extend(_makerNotePreviews(f, endian,
+                                                     exif[_MAKER_NOTE][0]))
+
+    return candidates
+
+
+def _readIFD(f: T.BinaryIO, endian: str, offset: int, wanted: T.Set[int],
+             base: int=0) -> T.Tuple[T.Dict[int, T.List[int]], int]:
+    '''Read one IFD, returning its wanted tags and the next IFD's offset.
+
+    Numeric tags come back as their values; undefined (byte blob) ones as the
+    offset and length of the blob, which we never need to read in full.
+    Offsets inside the IFD are relative to `base`.
+    '''
+    f.seek(offset)
+    count, = struct.unpack(endian + 'H', f.read(2))
+    raw = f.read(count * 12 + 4)
+
+    tags = {}
+    for i in range(count):
+        tag, typ, n, value = struct.unpack_from(endian + 'HHI4s', raw, i * 12)
+        if tag not in wanted or typ not in _TYPE_SIZES or not n:
+            continue
+
+        size = _TYPE_SIZES[typ] * n
+        if typ == _UNDEFINED:
+            if size > 4:
+                tags[tag] = [base + struct.unpack(endian + 'I', value)[0], n]
+            continue
+        if size > 4:
+            # doesn't fit inline, so it's an offset to the values
+            f.seek(base + struct.unpack(endian + 'I', value)[0])
+            value = f.read(size)
+        fmt = '{}{}{}'.format(endian, n, _TYPE_CODES[typ])
+        tags[tag] = list(struct.unpack_from(fmt, value))
+
+    nextIFD, = struct.unpack_from(endian + 'I', raw, count * 12)
+    return tags, nextIFD
+
+
+def _previewsIn(tags: T.Dict[int, T.List[int]]) -> T.List[T.Tuple[int, int]]:
+    previews = []
+    if _JPEG_OFFSET in tags and _JPEG_LENGTH in tags:
+        previews.append((tags[_JPEG_OFFSET][0], tags[_JPEG_LENGTH][0]))
+    if _RW2_JPEG in tags:
+        previews.append(tuple(tags[_RW2_JPEG]))
+
+    isRaw = (tags.get(_PHOTOMETRIC, [None])[0] in _RAW_PHOTOMETRIC
+             or _CR2_SLICE in tags)
+    if (tags.get(_COMPRESSION, [None])[0] in _JPEG_COMPRESSION and not isRaw
+            and _STRIP_OFFSETS in tags and _STRIP_BYTE_COUNTS in tags):
+        offsets, counts = tags[_STRIP_OFFSETS], tags[_STRIP_BYTE_COUNTS]
+        # only worth it if the strips are one contiguous run of bytes
+        contiguous = all(o + c == n for o, c, n
+                         in zip(offsets, counts, offsets[1:]))
+        if contiguous:
+            previews.append((offsets[0], sum(counts)))
+
+    return previews
+
+
+def _makerNotePreviews(f: T.BinaryIO, endian: str,
+                       note: int) -> T.List[T.Tuple[int, int]]:
+    '''Previews kept in Olympus (ORF) and Pentax (PEF) maker notes.
+
+    Both are IFDs behind a short header, with offsets relative to the start
+    of the maker note rather than of the file.
+    '''
+    f.seek(note)
+    header = f.read(12)
+    if header.startswith(b'OLYMPUS\x00'):
+        endian = _BYTE_ORDERS.get(header[8:10], endian)
+        tags, _ = _readIFD(f, endian, note + 12, {_OLYMPUS_CAMERA_SETTINGS},
+                           note)
+        if _OLYMPUS_CAMERA_SETTINGS not in tags:
+            return []
+        # either a blob holding the IFD (offset and length), or a pointer to
+        # it, depending on the model
+        settings = tags[_OLYMPUS_CAMERA_SETTINGS]
+        where = settings[0] if len(settings) == 2 else note + settings[0]
+        tags, _ = _readIFD(f, endian, where,
+                           {_OLYMPUS_PREVIEW_START, _OLYMPUS_PREVIEW_LENGTH},
+                           note)
+        start, length = _OLYMPUS_PREVIEW_START, _OLYMPUS_PREVIEW_LENGTH
+    elif header.startswith(b'AOC\x00'):
+        endian = _BYTE_ORDERS.get(header[4:6], endian)
+        tags, _ = _readIFD(f, endian, note + 6,
+                           {_PENTAX_PREVIEW_START, _PENTAX_PREVIEW_LENGTH}, note)
+        start, length = _PENTAX_PREVIEW_START, _PENTAX_PREVIEW_LENGTH
+    else:
+        return []
+
+    if start in tags and length in tags:
+        return [(note + tags[start][0], tags[length][0])]
+    return []
+
+
+def _isDisplayableJPEG(data: bytes) -> bool:
+    '''Walk the JPEG markers up to the frame header to check its type.'''
+    if data[:2] != b'\xff\xd8':
+        return False
+
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return False
+        marker = data[pos + 1]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return marker in _DISPLAYABLE_SOF
+        length, = struct.unpack_from('>H', data, pos + 2)
+        pos += 2 + length
+    return False
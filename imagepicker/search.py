@@ -0,0 +1,194 @@
+#-*- coding: utf-8 -*-
+'''
+Finding files in the input list by name or by substring, quickly enough to be
+used interactively on a million paths.
+'''
+from array import array
+from bisect import bisect_left
+import os
+import threading
+import typing as T
+
+
+def _trigrams(s: str) -> T.Set[str]:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+class PathIndex:
+    '''Index over a list of (relative) paths.
+
+    File names are kept sorted for exact lookups, and file names and
+    directories each get a trigram index for substring searches -- indexing
+    the directories separately keeps the index small, since many files share
+    each one. The index is built on a background thread; until it's ready,
+    searches just scan the list.
+
+    Files appended to the list afterwards are indexed by `update`.
+    '''
+
+    def __init__(self, files: T.Sequence[str], background: bool=True) -> None:
+        self._files = files
+        self._ready = threading.Event()
+        # guards indexing the tail of the list, so `update` can't race the
+        # end of the initial build
+        self._lock = threading.Lock()
+        self._indexed = 0
+        if background:
+            threading.Thread(target=self._build, daemon=True,
+                             name='PathIndex').start()
+        else:
+            self._build()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def _build(self) -> None:
+        self._dirIds = {}  # type: T.Dict[str, int]
+        self._dirNames = []  # type: T.List[str]
+        self._dirFiles = []  # type: T.List[array]
+        self._names = []  # type: T.List[str]
+        self._nameGrams = {}  # type: T.Dict[str, array]
+        self._dirGrams = {}  # type: T.Dict[str, array]
+
+        self._indexed = len(self._files)
+        for i in range(self._indexed):
+            self._add(i)
+
+        order = sorted(range(len(self._names)), key=self._names.__getitem__)
+        self._sortedNames = [self._names[i] for i in order]
+        self._nameOrder = array('I', order)
+
+        with self._lock:
+            self._ready.set()
+        self.update()
+
+    def _add(self, i: int) -> None:
+        dirname, name = os.path.split(self._files[i].lower())
+        self._names.append(name)
+        if dirname not in self._dirIds:
+            dirId = self._dirIds[dirname] = len(self._dirNames)
+            self._dirNames.append(dirname)
+            self._dirFiles.append(array('I'))
+            for gram in _trigrams(dirname):
+                self._dirGrams.setdefault(gram, array('I')).append(dirId)
+        self._dirFiles[self._dirIds[dirname]].append(i)
+        for gram in _trigrams(name):
+            self._nameGrams.setdefault(gram, array('I')).append(i)
+
+    def update(self) -> None:
+        '''Index any files appended to the list since we last looked.'''
+        with self._lock:
+            if not self.ready:
+                # the initial build will pick them up
+                return
+            for i in range(self._indexed, len(self._files)):
+                self._add(i)
+                pos = bisect_left(self._sortedNames, self._names[i])
+                self._sortedNames.insert(pos, self._names[i])
+                self._nameOrder.insert(pos, i)
+            self._indexed = len(self._files)
+
+    def exact(self, name: str) -> T.List[int]:
+        '''Indices of files with exactly this (case-insensitive) file name --
+        or relative path, if it has a directory in it.'''
+        if '/' in name:
+            return self._exactPath(name.lower())
+        name = name.lower()
+        if not self.ready:
+            return [i for i, p in enumerate(self._files)
+                    if os.path.basename(p).lower() == name]
+
+        matches = []
+        pos = bisect_left(self._sortedNames, name)
+        while pos < len(self._sortedNames) and self._sortedNames[pos] == name:
+            matches.append(self._nameOrder[pos])
+            pos += 1
+        return sorted(matches)
+
+    def _exactPath(self, path: str) -> T.List[int]:
+        path = os.path.normpath(path)
+        if not self.ready:
+            return [i for i, p in enumerate(self._files) if p.lower() == path]
+        dirname, name = os.path.split(path)
+        dirId = self._dirIds.get(dirname)
+        if dirId is None:
+            return []
+        return [i for i in self._dirFiles[dirId] if self._names[i] == name]
+
+    def substring(self, query: str, limit: int=100) -> T.List[int]:
+        '''Indices of the first `limit` files whose path contains `query`.'''
+        query = query.lower()
+        if self.ready and '/' in query:
+            return self._spanning(query, limit)
+        if not self.ready or len(query) < 3:
+            # too short to use the trigrams, so do it the slow way
+            return self._scan(query, limit)
+
+        # the rarest trigram gives the fewest candidates to check
+        grams = _trigrams(query)
+        empty = array('I')
+        names = min((self._nameGrams.get(g, empty) for g in grams), key=len)
+        dirs = min((self._dirGrams.get(g, empty) for g in grams), key=len)
+
+        matches = {i for i in names if query in self._names[i]}
+        for dirId in dirs:
+            if query in self._dirNames[dirId]:
+                matches.update(self._dirFiles[dirId])
+        return sorted(matches)[:limit]
+
+    def _spanning(self, query: str, limit: int) -> T.List[int]:
+        '''Substring search for a query that may span directory and name.
+
+        The part before the last slash has to be in (the end of) the
+        directory, and the part after it in the file name, so each narrows
+        the candidates by its own trigrams.
+        '''
+        head, _, tail = query.rpartition('/')
+        if len(head) < 3 and len(tail) < 3:
+            return self._scan(query, limit)
+
+        empty = array('I')
+        if len(head) >= 3:
+            dirs = min((self._dirGrams.get(g, empty) for g in _trigrams(head)),
+                       key=len)  # type: T.Iterable[int]
+        else:
+            dirs = range(len(self._dirNames))
+        names = None  # type: T.Optional[T.Set[int]]
+        if len(tail) >= 3:
+            names = set(min((self._nameGrams.get(g, empty)
+                             for g in _trigrams(tail)), key=len))
+
+        matches = set()  # type: T.Set[int]
+        for dirId in dirs:
+            dirname = self._dirNames[dirId]
+            if query in dirname:
+                matches.update(self._dirFiles[dirId])
+            elif dirname and dirname.endswith(head):
+                matches.update(
+                    i for i in self._dirFiles[dirId]
+                    if (names is None or i in names)
+                    and query in dirname + '/' + self._names[i])
+        return sorted(matches)[:limit]
+
+    def _scan(self, query: str, limit: int) -> T.List[int]:
+        matches = []
+        for i, path in enumerate(self._files):
+            if query in path.lower():
+                matches.append(i)
+                if len(matches) >= limit:
+                    break
+        return matches
+
+    def find(self, query: str, limit: int=100) -> T.List[int]:
+        '''Look up by exact file name, then substring -- or by index, as '#N'.
+
+        Bare numbers are searched for like any other text, so that '0001'
+        finds IMG_0001.JPG rather than the second file in the list.
+        '''
+        query = query.strip()
+        if query.startswith('#') and query[1:].isdigit():
+            index = int(query[1:])
+            return [index] if index < len(self._files) else []
+
+        return (self.exact(query) or self.substring(query, limit))[:limit]
@@ -3,19 +3,27 @@
 Define the UI
 '''
 from functools import partial
+import getpass
 import logging
+import sqlite3
+import threading
 import time
 import typing as T
 
 from PyQt5 import QtCore, QtGui
 from PyQt5.QtCore import Qt, QDir, QSize, QTimer, pyqtSignal, QEvent, QObject
-from PyQt5.QtGui import QImage, QPalette, QPixmap, QIcon
+from PyQt5.QtGui import QPalette, QPixmap, QIcon
 from PyQt5.QtWidgets import (QAction, QFileDialog, QLabel,
                              QMainWindow, QMenu, QMessageBox, QScrollArea,
                              QSizePolicy, QHBoxLayout, QVBoxLayout,
                              QPushButton, QWidget, QInputDialog)
 
+from imagepicker import analysis
+from imagepicker.cache import ByteCache
+from imagepicker.isolate import DecoderPool, DecodeError
 from imagepicker.model import PickerModel
+from imagepicker.navigation import NavigationScheduler
+from imagepicker.watch import TreeWatcher
 from imagepicker.utils import (computeScrollBarAdjustment, updateCountLabel)
 # side-effect-ful import initializes the image resources we know about
 import imagepicker.resources
@@ -50,7 +58,10 @@ UIActions = T.NamedTuple('Actions',
                        [('open', QAction), ('save', QAction), ('exit', QAction),
                         ('about', QAction), ('scaleToFullSize', QAction),
                         ('fitToWindow', QAction), ('addAlbum', QAction),
-                        ('removeAlbum', QAction)])
+                        ('removeAlbum', QAction), ('share', QAction),
+                        ('goTo', QAction), ('analyze', QAction),
+                        ('skipRejects', QAction), ('sortBySharpness', QAction),
+                        ('exportAlbum', QAction), ('pollInput', QAction)])
 
 Buttons = T.NamedTuple('Buttons',
                        [('previous', QPushButton), ('next', QPushButton),
@@ -92,6 +103,19 @@ class ImagePicker(QMainWindow):
     logger: logging.Logger = None
     _imagesLoaded: bool = False
     _imageCache: T.Dict = None
+    _byteCache: ByteCache = None
+    _navigator: NavigationScheduler = None
+    _watcher: TreeWatcher = None
+    _decoderPool: DecoderPool = None
+    # (file name, reduced?) of decodes we're waiting on
+    _decoding: T.Set[T.Tuple[str, bool]] = None
+    _previewFuture: T.Any = None
+
+    # how many upcoming files to read ahead, and the memory to do it in
+    readAheadCount = 300
+    readAheadBudget = 512 * 1024 * 1024
+    # milliseconds between reminders that we're still working on our chunk
+    heartbeatInterval = 60 * 1000
 
     # signals -- this is going to make pylint complain, but whatever
     imageChanged = pyqtSignal(int)
@@ -100,6 +124,13 @@ class ImagePicker(QMainWindow):
     albumAdded = pyqtSignal(str)
     albumRemoved = pyqtSignal(str)
     imageToggled = pyqtSignal(str, str)
+    imagesScored = pyqtSignal(list)
+    analysisFinished = pyqtSignal()
+    # the destination, and how many were exported -- or why it failed
+    albumExported = pyqtSignal(str, int)
+    exportFailed = pyqtSignal(str, str)
+    # file name, whether it's reduced-size, and the future of its QImage
+    imageDecoded = pyqtSignal(str, bool, object)
 
     @property
     def model(self) -> PickerModel:
@@ -113,6 +144,16 @@ class ImagePicker(QMainWindow):
 
         self.logger = logger
         self._imageCache = {}
+        self._byteCache = ByteCache(self.readAheadBudget, logger=logger)
+        self._navigator = NavigationScheduler(self._step, self)
+        self._watcher = TreeWatcher(self, logger)
+        self._decoderPool = DecoderPool(logger=logger)
+        self._decoding = set()
+        # on a timer, so that lingering over one image doesn't lose the chunk
+        self._heartbeatTimer = QTimer(self)
+        self._heartbeatTimer.setInterval(self.heartbeatInterval)
+        self._heartbeatTimer.timeout.connect(self._heartbeat)
+        self._heartbeatTimer.start()
         self._initUI()
         self._connectSlots()
         self._createActions()
@@ -145,6 +186,7 @@ class ImagePicker(QMainWindow):
         self.inputSelected.emit(inputDirectory)
         self.outputSelected.emit(fileName)
         self.imageChanged.emit(0)
+        self._watchInput()
 
     def _initButtons(self) -> None:
         prevBtn = QPushButton('« Previous')
@@ -280,7 +322,16 @@ class ImagePicker(QMainWindow):
         self.outputSelected.connect(
             lambda s: self.labels.output.setText('Out: ' + s))
         self.imageChanged.connect(self._updateDisplay)
+        self._navigator.previewRequested.connect(self._showPreview)
+        self._navigator.settled.connect(self.imageChanged)
+        self._watcher.changed.connect(self._inputChanged)
+        self.imagesScored.connect(self._imagesScored)
+        self.analysisFinished.connect(
+            lambda: self.actions.analyze.setEnabled(True))
+        self.albumExported.connect(self._albumExported)
+        self.exportFailed.connect(self._exportFailed)
         self.scrollArea.resized.connect(self._scaleImages)
+        self.imageDecoded.connect(self._imageDecoded)
 
         self.albumAdded.connect(self._updateDisplay)
         self.albumRemoved.connect(self._updateDisplay)
@@ -293,19 +344,28 @@ class ImagePicker(QMainWindow):
 
     def eventFilter(self, obj, event):
         if event.type() == QEvent.KeyPress:
-            return self._handleKeyPress(event.key())
+            return self._handleKeyPress(event.key(), event.isAutoRepeat())
+        if event.type() == QEvent.KeyRelease:
+            return self._handleKeyRelease(event.key(), event.isAutoRepeat())
         return super().eventFilter(obj, event)
 
-    def _handleKeyPress(self, key):
+    def _handleKeyPress(self, key, repeating=False):
         rv = True
         if key == QtCore.Qt.Key_Right:
-            self._advance()
+            self._navigator.move(1, repeating)
         elif key == QtCore.Qt.Key_Left:
-            self._retreat()
+            self._navigator.move(-1, repeating)
         else:
             rv = False
         return rv
 
+    def _handleKeyRelease(self, key, repeating=False):
+        if key not in (QtCore.Qt.Key_Right, QtCore.Qt.Key_Left):
+            return False
+        if not repeating:
+            self._navigator.settle()
+        return True
+
     def _createActions(self) -> None:
         _open = QAction("&Open...", self, shortcut="Ctrl+O",
                         triggered=self._open)
@@ -325,10 +385,33 @@ class ImagePicker(QMainWindow):
         _removeAlbum = QAction("&Remove Album...", self, shortcut="Ctrl+R",
                                triggered=self._removeAlbum)
 
+        _share = QAction("Sha&re Review...", self, triggered=self._share)
+        _exportAlbum = QAction("&Export Album...", self,
+                               triggered=self._exportAlbum)
+        _goTo = QAction("&Go To...", self, shortcut="Ctrl+G",
+                        triggered=self._goTo)
+        _analyze = QAction("&Analyze Images", self,
+                           enabled=analysis.available(),
+                           triggered=self._analyze)
+        _skipRejects = QAction("S&kip Likely Rejects", self, checkable=True,
+                               enabled=analysis.available(),
+                               triggered=self._skipRejects)
+        _sortBySharpness = QAction("Sort by S&harpness", self,
+                                   enabled=analysis.available(),
+                                   triggered=self._sortBySharpness)
+
+        _pollInput = QAction("&Poll Input for Changes", self, checkable=True,
+                             triggered=self._pollInput)
+
         self.actions = UIActions(open=_open, save=_save, exit=_exit,
                                  about=_about, scaleToFullSize=_scaleToFullSize,
                                  fitToWindow=_fitToWindow, addAlbum=_addAlbum,
-                                 removeAlbum=_removeAlbum)
+                                 removeAlbum=_removeAlbum, share=_share,
+                                 goTo=_goTo, analyze=_analyze,
+                                 skipRejects=_skipRejects,
+                                 sortBySharpness=_sortBySharpness,
+                                 exportAlbum=_exportAlbum,
+                                 pollInput=_pollInput)
 
     def _createMenus(self) -> None:
         _file = QMenu("&File", self)
@@ -336,13 +419,22 @@ class ImagePicker(QMainWindow):
         _file.addAction(self.actions.save)
         _file.addAction(self.actions.addAlbum)
         _file.addAction(self.actions.removeAlbum)
+        _file.addAction(self.actions.exportAlbum)
+        _file.addAction(self.actions.share)
         _file.addSeparator()
         _file.addAction(self.actions.exit)
 
         _view = QMenu("&View", self)
+        _view.addAction(self.actions.goTo)
         _view.addAction(self.actions.scaleToFullSize)
         _view.addSeparator()
         _view.addAction(self.actions.fitToWindow)
+        _view.addSeparator()
+        _view.addAction(self.actions.analyze)
+        _view.addAction(self.actions.skipRejects)
+        _view.addAction(self.actions.sortBySharpness)
+        _view.addSeparator()
+        _view.addAction(self.actions.pollInput)
 
         _help = QMenu("&Help", self)
         _help.addAction(self.actions.about)
@@ -355,19 +447,47 @@ class ImagePicker(QMainWindow):
 
     def _open(self) -> None:
         dialog = QFileDialog(self, "Open File / Directory", QDir.currentPath(),
-                             "YAML (*.yml *.yaml)")
+                             "YAML (*.yml *.yaml);;Archives (*.zip *.tar)")
         dialog.exec_()
         results = dialog.selectedFiles()
         if not results:
             return
 
-        self.inputSelected.emit(results[0])
+        try:
+            self.model.loadInput(results[0])
+        except (OSError, ValueError, AssertionError) as e:
+            QMessageBox.critical(self, 'Error', "Can't open {}: {}".format(
+                results[0], e))
+            return
 
-        self.model.loadDirectory(results[0])
+        self.inputSelected.emit(results[0])
+        self._watchInput()
         if not self.model.inputFiles:
             return
 
-        self.imageChanged.emit(self.model.currentFile)
+        self.imageChanged.emit(self.model.current)
+
+    def _watchInput(self) -> None:
+        if self.model.treeRoot:
+            self._watcher.watch(self.model.treeRoot, self.model.allFiles,
+                                self.model.treeSnapshot)
+            # the watcher keeps it up to date from here on
+            self.model.treeSnapshot = None
+        else:
+            self._watcher.stop()
+
+    def _inputChanged(self, added: T.List[str], removed: T.List[str]) -> None:
+        self.logger.debug('input changed: %d added, %d removed',
+                          len(added), len(removed))
+        wasEmpty = not self.model.inputFiles
+        currentRemoved = self.model.applyChanges(added, removed)
+        if not self.model.inputFiles:
+            return
+        if currentRemoved or wasEmpty:
+            self.imageChanged.emit(self.model.current)
+        else:
+            self.labels.total.setText(
+                '{} of {}'.format(self.model.current, self.model.count))
 
     def _toggle(self, album: str) -> None:
         self.logger.debug('Toggled %s in %s', self.model.currentFile, album)
@@ -390,6 +510,39 @@ class ImagePicker(QMainWindow):
         self.model.save()
         self.outputSelected.emit(fileName)
 
+    def _share(self) -> None:
+        fileName, _ = QFileDialog.getSaveFileName(
+            self, 'Shared Review Queue', QDir.currentPath(),
+            'SQLite (*.db *.sqlite)')
+        if not fileName:
+            return
+
+        reviewer, _ = QInputDialog.getText(self, 'Share Review', 'Reviewer:',
+                                           text=getpass.getuser())
+        if not reviewer:
+            QMessageBox.critical(self, 'Error', 'No reviewer name specified!')
+            return
+
+        try:
+            claimed = self.model.sharePartition(fileName, reviewer)
+        except (AssertionError, sqlite3.Error) as e:
+            QMessageBox.critical(self, 'Error', "Can't share {}: {}".format(
+                fileName, e))
+            return
+        if not claimed:
+            QMessageBox.information(self, 'ImagePicker',
+                                    'Nothing left to claim in {}'.format(fileName))
+        if self.model.inputFiles:
+            self.imageChanged.emit(self.model.current)
+
+    def _heartbeat(self) -> None:
+        if not self._model:
+            return
+        try:
+            self.model.heartbeat()
+        except sqlite3.Error as e:
+            self.logger.warning('shared queue heartbeat failed: %s', e)
+
     def _addAlbum(self) -> None:
         if not self.model.inputDir:
             QMessageBox.critical(self, 'Error', 'No input directory selected')
@@ -408,6 +561,43 @@ class ImagePicker(QMainWindow):
         self._addAlbumButton(name)
         self.albumAdded.emit(name)
 
+    def _exportAlbum(self) -> None:
+        if not self.model.albums:
+            QMessageBox.critical(self, 'Error', 'No albums to export!')
+            return
+
+        name, ok = QInputDialog.getItem(self, 'Export Album', 'Album:',
+                                        self.model.albumNames, 0, False)
+        if not ok:
+            return
+        dirname = QFileDialog.getExistingDirectory(self, 'Export To',
+                                                   QDir.currentPath())
+        if not dirname:
+            return
+
+        # copying a big album out can take a while, so not on the GUI thread
+        self.actions.exportAlbum.setEnabled(False)
+
+        def run():
+            try:
+                count = self.model.exportAlbum(name, dirname)
+            except (OSError, ValueError) as e:
+                self.exportFailed.emit(dirname, str(e))
+            else:
+                self.albumExported.emit(dirname, count)
+
+        threading.Thread(target=run, daemon=True, name='Export').start()
+
+    def _albumExported(self, dirname: str, count: int) -> None:
+        self.actions.exportAlbum.setEnabled(True)
+        QMessageBox.information(self, 'ImagePicker',
+                                'Exported {} images to {}'.format(count, dirname))
+
+    def _exportFailed(self, dirname: str, error: str) -> None:
+        self.actions.exportAlbum.setEnabled(True)
+        QMessageBox.critical(self, 'Error', "Can't export to {}: {}".format(
+            dirname, error))
+
     def _removeAlbum(self) -> None:
         if not self.model.inputDir:
             QMessageBox.critical(self, 'Error', 'No input directory selected')
@@ -433,47 +623,153 @@ class ImagePicker(QMainWindow):
         self._updateDisplay()
 
     def _updateDisplay(self) -> None:
+        if not self.model.inputFiles:
+            return
         fileName = self.model.currentFile
         pixmap = self._loadImageFromCache(fileName)
 
-        self.labels.mainImage.setPixmap(pixmap)
-        self._scaleImages()
+        # if it's still decoding, leave what's there (the preview, likely)
+        # until `_imageDecoded` has the real thing
+        if not pixmap.isNull() or fileName in self.model.badFiles:
+            self.labels.mainImage.setPixmap(pixmap)
+            self._scaleImages()
 
         if not self._imagesLoaded:
             self.labels.currStripImage.setStyleSheet('border: 2px solid blue')
             self._imagesLoaded = True
 
+        self.actions.fitToWindow.setEnabled(True)
+        self._updateActions()
+
+        total = '{} of {}'.format(self.model.current, self.model.count)
+        if fileName in self.model.badFiles:
+            total += " (can't load: {})".format(self.model.badFiles[fileName])
+        self.labels.total.setText(total)
+        self._updateAlbumButtons()
+
+        self._byteCache.prefetch(self.model.upcomingFiles(
+            self.readAheadCount, self._navigator.direction))
+        # let the main image get painted before decoding the neighbours
+        QTimer.singleShot(0, self._updateFilmstrip)
+
+    def _updateFilmstrip(self) -> None:
         filmstripWidth = self.filmstrip.width()
         for fileName, labelName in [('prevFile', 'prevStripImage'),
                                     ('currentFile', 'currStripImage'),
                                     ('nextFile', 'nextStripImage')]:
             file_ = getattr(self.model, fileName)
             label_ = getattr(self.labels, labelName)
-            image = QImage(file_)
-            if image.isNull():
-                QMessageBox.information(self, "ImagePicker",
-                                        "Can't load {}".format(file_))
             pixmap = self._loadImageFromCache(file_).scaledToWidth(filmstripWidth)
             label_.setPixmap(pixmap)
 
-        self.actions.fitToWindow.setEnabled(True)
-        self._updateActions()
+    def _showPreview(self, index: int) -> None:
+        '''Cheaply show the image we're passing while scrolling quickly.
 
-        self.labels.total.setText('{} of {}'.format(self.model.current, self.model.count))
-        self._updateAlbumButtons()
+        Images already decoded are shown straight away. Others are only
+        previewed if their bytes are in memory, by a reduced-size decode in
+        the background that `_imageDecoded` shows when it's done -- nothing
+        here waits on the disk or a decoder. Only the latest preview matters,
+        so any still queued from earlier are dropped.
+        '''
+        fileName = self.model.currentFile
+        self.labels.total.setText('{} of {}'.format(index, self.model.count))
+        self._byteCache.prefetch(self.model.upcomingFiles(
+            self.readAheadCount, self._navigator.direction))
+
+        if fileName in self._imageCache:
+            pixmap, _ = self._imageCache[fileName]
+            self.labels.mainImage.setPixmap(pixmap)
+            self._scaleImages()
+        elif fileName in self._byteCache:
+            if self._previewFuture is not None:
+                self._previewFuture.cancel()
+            self._previewFuture = self._requestDecode(fileName,
+                                                      self.scrollArea.size())
 
     def _updateAlbumButtons(self) -> None:
         for name in self.model.albumNames:
             btn = self.buttons.albums[name]
             btn.setChecked(self.model.isPicked(name))
 
+    def _step(self, delta: int) -> int:
+        for _ in range(abs(delta)):
+            if delta > 0:
+                self.model.advance()
+            else:
+                self.model.retreat()
+        return self.model.current
+
     def _advance(self) -> None:
-        self.model.advance()
-        self.imageChanged.emit(self.model.currentFile)
+        self._navigator.move(1)
 
     def _retreat(self) -> None:
-        self.model.retreat()
-        self.imageChanged.emit(self.model.currentFile)
+        self._navigator.move(-1)
+
+    def _goTo(self) -> None:
+        query, _ = QInputDialog.getText(
+            self, 'Go To', 'File name, part of a path, or #number:')
+        if not query:
+            return
+
+        matches = self.model.find(query)
+        if not matches:
+            QMessageBox.information(self, 'ImagePicker',
+                                    'Nothing matches {}'.format(query))
+            return
+
+        index = matches[0]
+        if len(matches) > 1:
+            choices = ['{}: {}'.format(i, self.model.inputFiles[i])
+                       for i in matches]
+            choice, ok = QInputDialog.getItem(self, 'Go To', 'Matches:',
+                                              choices, 0, False)
+            if not ok:
+                return
+            index = matches[choices.index(choice)]
+
+        # whatever we were reading ahead is no use now
+        self._byteCache.cancel()
+        self.model.jumpTo(index)
+        self.imageChanged.emit(self.model.current)
+
+    def _analyze(self) -> None:
+        '''Score all the images in the background, passing results back in
+        batches through `imagesScored`.'''
+        self.actions.analyze.setEnabled(False)
+        filenames = self.model.inputPaths
+
+        def run():
+            batch = []
+            try:
+                for filename, scores in analysis.analyzeFiles(filenames):
+                    if scores is not None:
+                        batch.append((filename, scores))
+                    if len(batch) >= 100:
+                        self.imagesScored.emit(batch)
+                        batch = []
+                self.imagesScored.emit(batch)
+            finally:
+                # even if the pool broke, so that analysis can be re-run
+                self.analysisFinished.emit()
+
+        threading.Thread(target=run, daemon=True, name='Analysis').start()
+
+    def _imagesScored(self, batch: T.List[T.Tuple[str, T.Any]]) -> None:
+        self.model.scores.update(batch)
+        self.logger.debug('%d images scored so far', len(self.model.scores))
+
+    def _skipRejects(self) -> None:
+        self.model.skipRejects = self.actions.skipRejects.isChecked()
+
+    def _pollInput(self) -> None:
+        # for network filesystems we don't recognise as such
+        self._watcher.forcePolling = self.actions.pollInput.isChecked()
+        if self.model.treeRoot:
+            self._watcher.watch(self.model.treeRoot, self.model.allFiles)
+
+    def _sortBySharpness(self) -> None:
+        self.model.sortBySharpness()
+        self.imageChanged.emit(self.model.current)
 
     def _about(self) -> None:
         info = '''<p>
@@ -520,6 +816,8 @@ class ImagePicker(QMainWindow):
             scb.setValue(int(adjustment))
 
     def _loadImageFromCache(self, filename: str) -> QPixmap:
+        '''The file's image if it's been decoded -- otherwise a blank, with
+        the decode started in the background for `_imageDecoded` to show.'''
         self.logger.debug('%s', filename)
         if filename in self._imageCache:
             pixmap, _ = self._imageCache[filename]
@@ -527,14 +825,63 @@ class ImagePicker(QMainWindow):
             return pixmap
 
         self.logger.debug(' - not in cache')
-        image = QImage(filename)
-        if image.isNull():
-            QMessageBox.information(self, "ImagePicker",
-                                    "Can't load {}".format(filename))
+        if filename not in self.model.badFiles:
+            self._requestDecode(filename)
+        return QPixmap()
+
+    def _requestDecode(self, filename: str, size: QSize=None) -> T.Any:
+        '''Start decoding the file, unless we already are; returns the future.'''
+        key = (filename, size is not None)
+        if key in self._decoding:
+            return None
+        self._decoding.add(key)
+        future = self._decoderPool.submit(
+            partial(self._byteCache.get, filename), size)
+        # called on the pool's thread, so hand it over through the signal
+        future.add_done_callback(
+            lambda f: self.imageDecoded.emit(filename, key[1], f))
+        return future
+
+    def _imageDecoded(self, filename: str, reduced: bool, future: T.Any) -> None:
+        self._decoding.discard((filename, reduced))
+        if future.cancelled():
+            return
+        try:
+            image = future.result()
+        except DecodeError as e:
+            self.logger.warning("can't load %s: %s", filename, e)
+            if not reduced:
+                # don't hold the user up -- note it, and step over it from now on
+                self.model.markBad(filename, str(e))
+                if self.model.inputFiles and filename == self.model.currentFile:
+                    self._updateDisplay()
+            return
+        except Exception as e:  # pylint: disable=broad-except
+            # reading it failed, or no decoder could be started -- not
+            # necessarily the file's fault, so leave it to be tried again
+            self.logger.warning("couldn't load %s: %s", filename, e)
+            return
 
-        self.logger.debug(' - loaded QImage: %s', image)
         pixmap = QPixmap.fromImage(image)
         self.logger.debug(' - loaded QPixmap: %s', pixmap)
+        if not self.model.inputFiles:
+            return
+        current = self.model.currentFile
+        if reduced:
+            # unless we've moved on, or the full image beat it to it
+            if filename == current and filename not in self._imageCache:
+                self.labels.mainImage.setPixmap(pixmap)
+                self._scaleImages()
+            return
+
+        self._cacheImage(filename, pixmap)
+        if filename == current:
+            self.labels.mainImage.setPixmap(pixmap)
+            self._scaleImages()
+        if filename in (self.model.prevFile, current, self.model.nextFile):
+            self._updateFilmstrip()
+
+    def _cacheImage(self, filename: str, pixmap: QPixmap) -> None:
         self._imageCache[filename] = (pixmap, time.time())
 
         # cache pruning
@@ -543,5 +890,3 @@ class ImagePicker(QMainWindow):
                          key=lambda k: self._imageCache[k][1])[0]
             del self._imageCache[lru]
             self.logger.debug(' - pruned cache')
-
-        return pixmap
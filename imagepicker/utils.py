@@ -1,4 +1,5 @@
 '''Helpers'''
+import io
 import os
 import mimetypes
 import pdb
@@ -7,17 +8,100 @@ import typing as T
 from PyQt5.QtWidgets import QLabel, QScrollBar
 from PyQt5.QtCore import pyqtRemoveInputHook
 
+from imagepicker.archive import splitMemberPath
+from imagepicker.raw import isRawFile, extractPreview, extractPreviewFrom
+
+
+def isImageFile(fname: str) -> bool:
+    '''Does the file name look like an image?'''
+    typ, __ = mimetypes.guess_type(fname)
+    # not every system's MIME database knows about RAW formats
+    return bool(typ and typ.startswith('image/')) or isRawFile(fname)
+
 
 def listImageFiles(directory: str) -> T.Generator[str, None, None]:
     '''Given a directory, yield all the images files in the tree.'''
     for root, _, files in os.walk(directory):
         for fname in files:
-            typ, __ = mimetypes.guess_type(fname)
-            if typ and typ.startswith('image/'):
+            if isImageFile(fname):
                 full_path = os.path.join(root, fname)
                 yield os.path.relpath(full_path, directory)
 
 
+def listAlbumFiles(directory: str) -> T.Generator[str, None, None]:
+    '''Given an album directory, yield the (absolute) paths of its images.
+
+    Album entries are mostly symlinks, which are read straight from the
+    directory listing rather than resolved one `stat` at a time.
+    '''
+    directory = os.path.abspath(directory)
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not isImageFile(entry.name):
+                continue
+            if entry.is_symlink():
+                target = os.readlink(entry.path)
+                yield os.path.normpath(os.path.join(directory, target))
+            elif entry.is_file():
+                yield entry.path
+
+
+def isAlbumDirectory(directory: str) -> bool:
+    '''Does this look like an album -- links to images, but no subdirectories?'''
+    hasLinks = False
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_symlink():
+                hasLinks = True
+            elif entry.is_dir():
+                return False
+    return hasLinks
+
+
+def readImageBytes(filename: str, maxSize: int=None) -> bytes:
+    '''Read the whole (still compressed) file in one large sequential read.
+
+    For RAW files, only the embedded JPEG preview is read. Archive members
+    (see `imagepicker.archive`) are read straight out of the archive, unless
+    they would inflate to more than `maxSize` bytes.
+    '''
+    try:
+        if isRawFile(filename):
+            return extractPreview(filename)
+        return _readFile(filename)
+    except (FileNotFoundError, NotADirectoryError):
+        found = splitMemberPath(filename)
+        if not found:
+            raise
+
+    archive, name = found
+    if isRawFile(filename):
+        if archive.isStored(name):
+            # only the preview's bytes need reading, as from a plain file
+            with archive.openMember(name) as f:
+                return extractPreviewFrom(f, filename)
+        return extractPreviewFrom(io.BytesIO(archive.read(name, maxSize)),
+                                  filename)
+    return archive.read(name, maxSize)
+
+
+def _readFile(filename: str) -> bytes:
+    with open(filename, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, size, os.POSIX_FADV_SEQUENTIAL)
+        data = bytearray(size)
+        view = memoryview(data)
+        read = 0
+        while read < size:
+            n = f.readinto(view[read:])
+            if not n:
+                break
+            read += n
+    # NOTE: a bytearray rather than bytes, to save copying it again
+    return data if read == size else data[:read]
+
+
 def computeScrollBarAdjustment(scrollbar: QScrollBar, scale: float):
     '''Calculate the adjustment for the scroll bar at the scale factor.'''
     adj = scale * scrollbar.value() + ((scale - 1) * scrollbar.pageStep() / 2)
@@ -0,0 +1,315 @@
+#-*- coding: utf-8 -*-
+'''
+Watching the input tree for files arriving (or going away) during a session,
+without rescanning the whole thing.
+'''
+import logging
+import os
+import re
+import threading
+import typing as T
+
+from PyQt5.QtCore import QObject, QTimer, QFileSystemWatcher, pyqtSignal
+
+from imagepicker.utils import isImageFile
+
+
+Changes = T.Tuple[T.List[str], T.List[str]]
+
+# inotify only sees changes made by this machine, so on these it would miss
+# files written by anyone else
+NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', '9p', 'afs',
+                       'ceph', 'glusterfs', 'lustre', 'fuse.sshfs',
+                       'fuse.glusterfs'}
+
+
+def isNetworkMount(path: str) -> bool:
+    '''Is the path on a network filesystem? (Only known on Linux.)'''
+    path = os.path.realpath(path)
+    best, fsType = '', ''
+    try:
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # spaces and such in mount points are octal-escaped
+                mountPoint = re.sub(r'\\([0-7]{3})',
+                                    lambda m: chr(int(m.group(1), 8)), fields[1])
+                inside = (path == mountPoint or path.startswith(
+                    mountPoint.rstrip('/') + '/'))
+                if inside and len(mountPoint) >= len(best):
+                    best, fsType = mountPoint, fields[2]
+    except OSError:
+        return False
+    return fsType in NETWORK_FILESYSTEMS
+
+
+class TreeSnapshot:
+    '''What was in each directory of a tree last time we looked.
+
+    Adding or removing an entry changes the directory's mtime, so only
+    directories whose mtime has moved need listing again.
+    '''
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        # directory -> (mtime, image file names, subdirectory names)
+        self._dirs = {}  # type: T.Dict[str, T.Tuple[int, T.Set[str], T.Set[str]]]
+
+    @property
+    def directories(self) -> T.List[str]:
+        return list(self._dirs)
+
+    def files(self) -> T.Iterator[str]:
+        '''All the image files, relative to the root.'''
+        for dirname, (_, images, _) in self._dirs.items():
+            for name in images:
+                yield os.path.relpath(os.path.join(dirname, name), self.root)
+
+    def scan(self) -> None:
+        '''Take the initial snapshot of the whole tree.'''
+        self._dirs = {}
+        self._scanTree(self.root, [])
+
+    def refresh(self, dirnames: T.Iterable[str]=None) -> Changes:
+        '''Re-check the given (or all) directories, returning what changed.'''
+        added, removed = [], []  # type: T.List[str], T.List[str]
+        for dirname in list(self._dirs if dirnames is None else dirnames):
+            if dirname not in self._dirs:
+                continue
+            try:
+                mtime = os.stat(dirname).st_mtime_ns
+            except OSError:
+                self._forget(dirname, removed)
+                continue
+            if mtime != self._dirs[dirname][0]:
+                self._rescan(dirname, added, removed)
+        return added, removed
+
+    def _list(self, dirname: str) -> T.Tuple[int, T.Set[str], T.Set[str]]:
+        images, subdirs = set(), set()
+        mtime = os.stat(dirname).st_mtime_ns
+        with os.scandir(dirname) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.add(entry.name)
+                elif isImageFile(entry.name):
+                    images.add(entry.name)
+        return mtime, images, subdirs
+
+    def _relative(self, dirname: str, name: str) -> str:
+        return os.path.relpath(os.path.join(dirname, name), self.root)
+
+    def _scanTree(self, dirname: str, added: T.List[str]) -> None:
+        try:
+            entry = self._list(dirname)
+        except OSError:
+            return
+        self._dirs[dirname] = entry
+        added.extend(self._relative(dirname, name) for name in entry[1])
+        for sub in entry[2]:
+            self._scanTree(os.path.join(dirname, sub), added)
+
+    def _forget(self, dirname: str, removed: T.List[str]) -> None:
+        _, images, subdirs = self._dirs.pop(dirname)
+        removed.extend(self._relative(dirname, name) for name in images)
+        for sub in subdirs:
+            if os.path.join(dirname, sub) in self._dirs:
+                self._forget(os.path.join(dirname, sub), removed)
+
+    def _rescan(self, dirname: str, added: T.List[str],
+                removed: T.List[str]) -> None:
+        try:
+            mtime, images, subdirs = self._list(dirname)
+        except OSError:
+            self._forget(dirname, removed)
+            return
+
+        _, oldImages, oldSubdirs = self._dirs[dirname]
+        self._dirs[dirname] = (mtime, images, subdirs)
+        added.extend(self._relative(dirname, n) for n in images - oldImages)
+        removed.extend(self._relative(dirname, n) for n in oldImages - images)
+        for sub in subdirs - oldSubdirs:
+            self._scanTree(os.path.join(dirname, sub), added)
+        for sub in oldSubdirs - subdirs:
+            if os.path.join(dirname, sub) in self._dirs:
+                self._forget(os.path.join(dirname, sub), removed)
+
+
+class TreeWatcher(QObject):
+    '''Tell us about images added to or removed from a tree.
+
+    Directories are watched with QFileSystemWatcher (inotify, on Linux);
+    any it can't watch -- past the system's limit, say -- are polled instead.
+    Trees on network filesystems are polled throughout, as is any tree if
+    `forcePolling` is set. Re-checking directories means a stat of each, which
+    on a big network tree takes a while, so it's done on a background thread
+    -- one refresh at a time, with any asked for meanwhile queued up behind it.
+    '''
+
+    # added, removed -- relative to the root, as from `listImageFiles`
+    changed = pyqtSignal(list, list)
+    _scanned = pyqtSignal(int, object, list, list)
+    # generation, new directories, added, removed
+    _refreshed = pyqtSignal(int, list, list, list)
+
+    # milliseconds
+    pollInterval = 1000
+    debounceDelay = 200
+
+    def __init__(self, parent: QObject=None,
+                 logger: logging.Logger=None) -> None:
+        super().__init__(parent)
+        self.logger = logger or logging.getLogger(__name__)
+        self.forcePolling = False
+        self._snapshot = None  # type: T.Optional[TreeSnapshot]
+        self._dirty = set()  # type: T.Set[str]
+        self._unwatched = []  # type: T.List[str]
+        # bumped on each `watch`, so that a stale scan finishing is ignored
+        self._generation = 0
+
+        self._watcher = None  # type: T.Optional[QFileSystemWatcher]
+        self._scanned.connect(self._started)
+        self._refreshed.connect(self._finishRefresh)
+        # directories waiting to be re-checked (None for all of them), and
+        # whether a refresh is running
+        self._queued = set()  # type: T.Optional[T.Set[str]]
+        self._refreshing = False
+
+        self._debounceTimer = QTimer(self)
+        self._debounceTimer.setSingleShot(True)
+        self._debounceTimer.setInterval(self.debounceDelay)
+        self._debounceTimer.timeout.connect(self._refreshDirty)
+
+        self._pollTimer = QTimer(self)
+        self._pollTimer.setInterval(self.pollInterval)
+        self._pollTimer.timeout.connect(self._poll)
+
+    def watch(self, root: str, known: T.Sequence[str],
+              snapshot: TreeSnapshot=None) -> None:
+        '''Start watching the tree; `known` is the file list we already have.
+
+        If `known` was listed from a `snapshot` of the tree, pass that too and
+        it's used as it is. Otherwise the snapshot is taken on a background
+        thread, and anything that arrived since `known` was listed is reported
+        once it's done.
+        '''
+        self.stop()
+        generation = self._generation
+        if snapshot is not None:
+            self._started(generation, snapshot, [], [])
+            # catch anything that arrived before the watches were in place
+            self._refresh(None)
+            return
+
+        snapshot = TreeSnapshot(root)
+        known = set(known)
+
+        def scan():
+            snapshot.scan()
+            files = set(snapshot.files())
+            self._scanned.emit(generation, snapshot, sorted(files - known),
+                               sorted(known - files))
+
+        threading.Thread(target=scan, daemon=True, name='TreeWatcher').start()
+
+    def stop(self) -> None:
+        self._generation += 1
+        self._snapshot = None
+        self._dirty.clear()
+        self._unwatched = []
+        self._queued = set()
+        # any refresh still running is for the old generation, and ignored
+        self._refreshing = False
+        self._pollTimer.stop()
+        self._debounceTimer.stop()
+        if self._watcher is not None:
+            self._watcher.deleteLater()
+            self._watcher = None
+
+    def _started(self, generation: int, snapshot: TreeSnapshot,
+                 added: T.List[str], removed: T.List[str]) -> None:
+        if generation != self._generation:
+            return
+        self._snapshot = snapshot
+        if self.forcePolling or isNetworkMount(snapshot.root):
+            self.logger.info('polling %s for changes', snapshot.root)
+        else:
+            self._watcher = QFileSystemWatcher(self)
+            self._watcher.directoryChanged.connect(self._directoryChanged)
+        self._watch(snapshot.directories)
+        self._report(added, removed)
+
+    def _watch(self, dirnames: T.List[str]) -> None:
+        if not dirnames:
+            return
+        if self._watcher is None:
+            # polling everything
+            self._unwatched.extend(dirnames)
+            self._pollTimer.start()
+            return
+        failed = self._watcher.addPaths(dirnames)
+        if failed:
+            self.logger.info('polling %d directories we could not watch',
+                             len(failed))
+            self._unwatched.extend(failed)
+            self._pollTimer.start()
+
+    def _directoryChanged(self, dirname: str) -> None:
+        self._dirty.add(dirname)
+        self._debounceTimer.start()
+
+    def _refreshDirty(self) -> None:
+        dirty, self._dirty = self._dirty, set()
+        self._refresh(dirty)
+
+    def _poll(self) -> None:
+        self._refresh(self._unwatched)
+
+    def _refresh(self, dirnames: T.Optional[T.Iterable[str]]) -> None:
+        '''Re-check the given (or all) directories, in the background.'''
+        if self._snapshot is None:
+            return
+        if dirnames is None:
+            self._queued = None
+        elif self._queued is not None:
+            self._queued.update(dirnames)
+        if not self._refreshing:
+            self._startRefresh()
+
+    def _startRefresh(self) -> None:
+        dirnames = None if self._queued is None else list(self._queued)
+        self._queued = set()
+        self._refreshing = True
+        snapshot = self._snapshot
+        generation = self._generation
+
+        def refresh():
+            added, removed = [], []  # type: T.List[str], T.List[str]
+            newDirs = []  # type: T.List[str]
+            try:
+                before = set(snapshot.directories)
+                added, removed = snapshot.refresh(dirnames)
+                newDirs = [d for d in snapshot.directories if d not in before]
+            finally:
+                # always, or we'd never refresh again
+                self._refreshed.emit(generation, newDirs, added, removed)
+
+        threading.Thread(target=refresh, daemon=True,
+                         name='TreeWatcher').start()
+
+    def _finishRefresh(self, generation: int, newDirs: T.List[str],
+                       added: T.List[str], removed: T.List[str]) -> None:
+        if generation != self._generation:
+            return
+        self._refreshing = False
+        self._watch(newDirs)
+        self._report(added, removed)
+        if self._queued is None or self._queued:
+            self._startRefresh()
+
+    def _report(self, added: T.List[str], removed: T.List[str]) -> None:
+        if added or removed:
+            self.logger.debug('%d added, %d removed', len(added), len(removed))
+            self.changed.emit(added, removed)
@@ -0,0 +1,186 @@
+#-*- coding: utf-8 -*-
+'''
+Tests for finding the embedded previews in RAW files, on small synthetic ones.
+'''
+import io
+import struct
+
+import pytest
+
+from imagepicker import raw
+
+
+def _jpeg(sof: int=0xC0, size: int=64) -> bytes:
+    '''A JPEG, as far as the frame header -- padded out to `size`.'''
+    data = (b'\xff\xd8'
+            + b'\xff\xe0\x00\x06JFIF'  # APP0
+            + b'\xff\xc4\x00\x04\x00\x00'  # DHT, which looks like an SOF
+            + bytes([0xFF, sof]) + b'\x00\x0b\x08\x00\x10\x00\x10\x01\x01\x11\x00')
+    return data + b'\x00' * (size - len(data))
+
+
+def _ifd(endian: str, entries: list, nextIFD: int=0) -> bytes:
+    '''An IFD of (tag, type, count, value) entries, values given inline.'''
+    out = struct.pack(endian + 'H', len(entries))
+    for tag, typ, count, value in sorted(entries):
+        if isinstance(value, bytes):
+            packed = value
+        elif typ == 3 and count == 1:
+            packed = struct.pack(endian + 'HH', value, 0)
+        else:
+            packed = struct.pack(endian + 'I', value)
+        out += struct.pack(endian + 'HHI', tag, typ, count) + packed
+    return out + struct.pack(endian + 'I', nextIFD)
+
+
+class _File:
+    '''Lay out a TIFF-style file, a piece at a time.'''
+
+    def __init__(self, endian: str='<', magic: bytes=None) -> None:
+        self.endian = endian
+        magic = magic or (b'II*\x00' if endian == '<' else b'MM\x00*')
+        self.data = bytearray(magic + b'\x00' * 4)
+
+    def add(self, blob: bytes) -> int:
+        if len(self.data) % 2:
+            self.data += b'\x00'
+        offset = len(self.data)
+        self.data += blob
+        return offset
+
+    @property
+    def next(self) -> int:
+        return len(self.data) + len(self.data) % 2
+
+    def ifd(self, entries: list, nextIFD: int=0, first: bool=False) -> int:
+        offset = self.add(_ifd(self.endian, entries, nextIFD))
+        if first:
+            struct.pack_into(self.endian + 'I', self.data, 4, offset)
+        return offset
+
+    def preview(self) -> bytes:
+        return raw.extractPreviewFrom(io.BytesIO(bytes(self.data)), 'test')
+
+
+@pytest.mark.parametrize('sof, displayable', [
+    (0xC0, True), (0xC1, True), (0xC2, True), (0xC3, False), (0xCF, False)])
+def test_displayable_jpeg(sof, displayable):
+    assert raw._isDisplayableJPEG(_jpeg(sof)) is displayable
+
+
+def test_displayable_jpeg_rejects_junk():
+    assert not raw._isDisplayableJPEG(b'\x89PNG\r\n\x1a\n' + b'\x00' * 64)
+    assert not raw._isDisplayableJPEG(b'\xff\xd8\x00\x00' + b'\x00' * 64)
+    # cut off before the frame header
+    assert not raw._isDisplayableJPEG(_jpeg()[:14])
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_largest_preview_wins(endian):
+    f = _File(endian)
+    small, large = _jpeg(size=100), _jpeg(size=400)
+    smallAt, largeAt = f.add(small), f.add(large)
+    sub = f.ifd([(raw._COMPRESSION, 3, 1, 6),
+                 (raw._STRIP_OFFSETS, 4, 1, largeAt),
+                 (raw._STRIP_BYTE_COUNTS, 4, 1, len(large))])
+    f.ifd([(raw._JPEG_OFFSET, 4, 1, smallAt),
+           (raw._JPEG_LENGTH, 4, 1, len(small)),
+           (raw._SUB_IFDS, 4, 1, sub)], first=True)
+    assert f.preview() == large
+
+
+def test_sensor_data_is_skipped():
+    f = _File()
+    preview, sensor = _jpeg(size=100), _jpeg(0xC3, size=1000)
+    previewAt, sensorAt = f.add(preview), f.add(sensor)
+    ifd1 = f.ifd([(raw._JPEG_OFFSET, 4, 1, sensorAt),
+                  (raw._JPEG_LENGTH, 4, 1, len(sensor))])
+    f.ifd([(raw._JPEG_OFFSET, 4, 1, previewAt),
+           (raw._JPEG_LENGTH, 4, 1, len(preview))], nextIFD=ifd1, first=True)
+    assert f.preview() == preview
+
+
+def test_unused_tags_are_not_read():
+    f = _File()
+    preview = _jpeg()
+    at = f.add(preview)
+    # values well past the end of the file, which we'd fail to read
+    f.ifd([(raw._JPEG_OFFSET, 4, 1, at),
+           (raw._JPEG_LENGTH, 4, 1, len(preview)),
+           (271, 2, 1000, 1 << 30),  # Make
+           (50341, 7, 1000, 1 << 30)], first=True)  # PrintIM
+    assert f.preview() == preview
+
+
+def test_empty_tags_are_ignored():
+    f = _File()
+    preview = _jpeg()
+    at = f.add(preview)
+    f.ifd([(raw._JPEG_OFFSET, 4, 1, at),
+           (raw._JPEG_LENGTH, 4, 1, len(preview)),
+           (raw._SUB_IFDS, 4, 0, 0),
+           (raw._EXIF_IFD, 4, 0, 0)], first=True)
+    assert f.preview() == preview
+
+    f = _File()
+    f.ifd([(raw._JPEG_OFFSET, 4, 0, 0), (raw._JPEG_LENGTH, 4, 1, 100)],
+          first=True)
+    with pytest.raises(ValueError, match='no embedded preview'):
+        f.preview()
+
+
+def test_ifd_loops_terminate():
+    f = _File()
+    at = f.next
+    f.ifd([(raw._COMPRESSION, 3, 1, 1)], nextIFD=at, first=True)
+    with pytest.raises(ValueError, match='no embedded preview'):
+        f.preview()
+
+
+def test_rw2_jpg_from_raw():
+    f = _File(magic=b'IIU\x00')
+    preview = _jpeg(size=200)
+    at = f.add(preview)
+    f.ifd([(raw._RW2_JPEG, 7, len(preview), at)], first=True)
+    assert f.preview() == preview
+
+
+def _withMakerNote(f: _File, note: bytes) -> None:
+    noteAt = f.next
+    f.add(note)
+    exif = f.ifd([(raw._MAKER_NOTE, 7, len(note), noteAt)])
+    f.ifd([(raw._EXIF_IFD, 4, 1, exif)], first=True)
+
+
+def test_orf_maker_note():
+    preview = _jpeg(size=150)
+    header = b'OLYMPUS\x00II\x03\x00'
+    settings = len(header) + 18
+    previewAt = settings + 30
+    note = (header
+            + _ifd('<', [(raw._OLYMPUS_CAMERA_SETTINGS, 13, 1, settings)])
+            + _ifd('<', [(raw._OLYMPUS_PREVIEW_START, 4, 1, previewAt),
+                         (raw._OLYMPUS_PREVIEW_LENGTH, 4, 1, len(preview))])
+            + preview)
+    f = _File(magic=b'IIRO')
+    _withMakerNote(f, note)
+    assert f.preview() == preview
+
+
+def test_pef_maker_note():
+    preview = _jpeg(size=150)
+    header = b'AOC\x00MM'
+    previewAt = len(header) + 30
+    # the maker note's byte order needn't match the file's
+    note = (header
+            + _ifd('>', [(raw._PENTAX_PREVIEW_LENGTH, 4, 1, len(preview)),
+                         (raw._PENTAX_PREVIEW_START, 4, 1, previewAt)])
+            + preview)
+    f = _File()
+    _withMakerNote(f, note)
+    assert f.preview() == preview
+
+
+def test_not_a_raw_file():
+    with pytest.raises(ValueError):
+        raw.extractPreviewFrom(io.BytesIO(_jpeg()), 'test')